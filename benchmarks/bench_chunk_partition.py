@@ -0,0 +1,81 @@
+"""
+benchmark distributing BioSample and SRA rows into their submission file chunks:
+the single-pass partition_rows() against the previous per-chunk list scans
+
+usage: python benchmarks/bench_chunk_partition.py [--sizes 10000 100000 1000000] [--legacy-max 100000]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bpasubmit.ncbi import plan_sra_chunks, partition_rows  # noqa: E402
+from bpasubmit.index import PackageIndex  # noqa: E402
+
+
+def synthetic_rows(nsra, seed=0):
+    """
+    `nsra` SRA rows spread over samples with 1 to 12 rows each, one in twenty of them
+    for samples which already have a BioSample accession, and a BioSample row per sample.
+    rows are in sample id order, as the exporters build them.
+    """
+    rnd = random.Random(seed)
+    sra_rows = []
+    biosample_rows = []
+    sample_num = 1000
+    while len(sra_rows) < nsra:
+        sample_num += 1
+        existing = rnd.random() < 0.05
+        sample_name = None if existing else '102.100.100/%d' % sample_num
+        if not existing:
+            biosample_rows.append({'sample_name': sample_name})
+        for _ in range(min(rnd.randint(1, 12), nsra - len(sra_rows))):
+            sra_rows.append(({'sample_name': sample_name}, [['fastq', 'file.fastq.gz', 'md5']]))
+    return biosample_rows, sra_rows
+
+
+def legacy_partition_rows(sra_chunks, biosample_rows, sra_rows):
+    # the previous implementation: a scan of every row per chunk, testing list membership
+    biosample_chunks = []
+    sra_chunk_rows = []
+    for sample_ids in sra_chunks:
+        biosample_chunks.append([row for row in biosample_rows if row['sample_name'] in sample_ids])
+        sra_chunk_rows.append([row_res for row_res in sra_rows if row_res[0]['sample_name'] in sample_ids])
+    sra_existing = [t for t in sra_rows if not t[0]['sample_name']]
+    return biosample_chunks, sra_chunk_rows, sra_existing
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--legacy-max', type=int, default=100000, help='skip the legacy implementation above this many rows')
+    args = parser.parse_args()
+
+    print('{:>10} {:>8} {:>12} {:>12} {:>9}'.format('sra_rows', 'chunks', 'legacy (s)', 'single (s)', 'speed-up'))
+    for size in args.sizes:
+        biosample_rows, sra_rows = synthetic_rows(size)
+        index = PackageIndex(())
+        index.add_sra_rows(sra_rows)
+        sra_chunks = plan_sra_chunks(index, packing='ordered')
+        single, result = timed(partition_rows, sra_chunks, biosample_rows, index)
+        if size <= args.legacy_max:
+            legacy, legacy_result = timed(legacy_partition_rows, sra_chunks, biosample_rows, sra_rows)
+            assert legacy_result == result, 'partitions differ'
+            print('{:>10} {:>8} {:>12.3f} {:>12.3f} {:>8.0f}x'.format(size, len(sra_chunks), legacy, single, legacy / single))
+        else:
+            print('{:>10} {:>8} {:>12} {:>12.3f} {:>9}'.format(size, len(sra_chunks), 'skipped', single, '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+benchmark each stage of an export over a synthetic catalogue: the wall time, and peak
+memory allocated, of the embargo filter, grouping by (sample_id, depth), building BioSample
+rows (including the grouping), the package filters, building SRA rows, and writing the
+submission files.
+
+results are saved to benchmarks/results/<commit>.json, and with --compare are shown
+against those saved for another commit.
+
+the 'apply_embargo' stage is the project's package filter pipeline, which applies the
+embargo (and for MM, mandatory field) rules in the place apply_embargo used to. peak memory
+is traced in a second, separate run of each stage, so it does not slow the timings; it only
+covers this process, not the write_sra_biosample worker processes.
+
+usage: python benchmarks/bench_pipeline.py [--project base mm] [--sizes 1000 10000 100000 1000000]
+                                           [--write-workers 1] [--compress gzip] [--no-memory]
+                                           [--compare COMMIT]
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bpasubmit.synthetic import synthetic_packages  # noqa: E402
+from bpasubmit.filters import FilterPipeline  # noqa: E402
+from bpasubmit.index import PackageIndex  # noqa: E402
+from bpasubmit.ncbi import write_sra_biosample  # noqa: E402
+from bpasubmit.sinks import FileSink, COMPRESSIONS  # noqa: E402
+from bpasubmit.projects.base.submission import BASE  # noqa: E402
+from bpasubmit.projects.mm.submission import MarineMicrobes  # noqa: E402
+
+PROJECTS = {'base': BASE, 'mm': MarineMicrobes}
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def commit():
+    """
+    the current commit, marked if the tree has uncommitted changes
+    """
+    def git(*args):
+        return subprocess.check_output(('git',) + args, cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf8').strip()
+    try:
+        rev = git('rev-parse', '--short', 'HEAD')
+        dirty = git('status', '--porcelain', '--untracked-files=no', '--', '../bpasubmit')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return rev + ('-dirty' if dirty else '')
+
+
+def stages(project, n, write_workers, compress=None):
+    """
+    yields (stage, setup, run) for each stage of an export of `n` synthetic `project` packages.
+    setup() is not measured, and returns the arguments to run(), which is; run() returns
+    the number of records it produced.
+    """
+    cls = PROJECTS[project]
+    projection = cls.projection
+    raw = [projection(t) for t in synthetic_packages(n, project)]
+    args = argparse.Namespace(
+        packing='ffd', output_dir=None, write_workers=write_workers, verify_md5=False, incremental=False)
+
+    def embargo(packages):
+        return FilterPipeline('package', cls.package_rules).run(packages)[0]
+    yield 'apply_embargo', lambda: (raw,), lambda packages: len(embargo(packages))
+
+    exporter = cls.from_packages([projection.record(t) for t in embargo(raw)], args)
+    del raw
+
+    yield ('_build_id_depth_metadata', lambda: (exporter.index.by_sample_id(),),
+           lambda packages: len(exporter._build_id_depth_metadata(packages)))
+    yield 'ncbi_metagenome_objects', lambda: (), lambda: len(list(exporter.ncbi_metagenome_objects()))
+    yield ('packages_to_submit', lambda: (exporter.index.by_sample_id(),),
+           lambda packages: len(list(exporter.packages_to_submit(packages))))
+    yield 'ncbi_sra_objects', lambda: (), lambda: len(list(exporter.ncbi_sra_objects()))
+
+    biosample_rows = list(exporter.ncbi_metagenome_objects())
+    sra_rows = list(exporter.ncbi_sra_objects())
+
+    def write(index, output_dir):
+        try:
+            manifest = write_sra_biosample(
+                biosample_custom_fields=('depth', 'isolate'), biosample_base='Metagenome.environmental.1.0-bench',
+                biosample_rows=biosample_rows, sra_custom_fields=('depth', 'isolate'), sra_base='SRA_subtemplate_v2-8-bench',
+                sra_rows=sra_rows, output_dir=output_dir, workers=write_workers, index=index,
+                sink=FileSink(compression=compress))
+        finally:
+            shutil.rmtree(output_dir)
+        return sum(t['rows'] for t in manifest)
+    yield 'write_sra_biosample', lambda: (PackageIndex(exporter.packages), tempfile.mkdtemp()), write
+
+
+def measure(setup, run, memory):
+    gc.collect()
+    args = setup()
+    start = time.perf_counter()
+    count = run(*args)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        args = setup()
+        gc.collect()
+        tracemalloc.start()
+        run(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return count, elapsed, peak
+
+
+def load_results(rev):
+    filename = os.path.join(RESULTS_DIR, '{}.json'.format(rev))
+    if not os.path.exists(filename):
+        sys.exit('no results saved for {}'.format(rev))
+    with open(filename) as fd:
+        return dict(((t['project'], t['size'], t['stage']), t) for t in json.load(fd)['results'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--project', nargs='+', choices=sorted(PROJECTS), default=sorted(PROJECTS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--write-workers', type=int, default=1)
+    parser.add_argument('--compress', choices=COMPRESSIONS, help='compress the submission files written')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracing peak memory')
+    parser.add_argument('--compare', metavar='COMMIT', help='compare with the results saved for this commit')
+    args = parser.parse_args()
+
+    # the exporters log a summary per stage; keep the table readable
+    logging.getLogger('bpasubmit').setLevel(logging.WARNING)
+
+    previous = load_results(args.compare) if args.compare else {}
+    rev = commit()
+    results = []
+    print('commit {}'.format(rev))
+    print('{:<5} {:>8} {:<26} {:>9} {:>10} {:>10} {:>9}'.format(
+        'proj', 'packages', 'stage', 'records', 'time (s)', 'peak (MB)', 'vs prev'))
+    for project in args.project:
+        for size in args.sizes:
+            for stage, setup, run in stages(project, size, args.write_workers, args.compress):
+                count, elapsed, peak = measure(setup, run, not args.no_memory)
+                result = {
+                    'project': project, 'size': size, 'stage': stage, 'records': count,
+                    'seconds': elapsed, 'peak_bytes': peak}
+                results.append(result)
+                before = previous.get((project, size, stage))
+                change = '{:+.0f}%'.format(100.0 * (elapsed / before['seconds'] - 1)) if before else '-'
+                print('{:<5} {:>8} {:<26} {:>9} {:>10.3f} {:>10} {:>9}'.format(
+                    project, size, stage, count, elapsed,
+                    '-' if peak is None else '{:.1f}'.format(peak / 2.0 ** 20), change))
+
+    if not os.path.isdir(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+    filename = os.path.join(RESULTS_DIR, '{}.json'.format(rev))
+    with open(filename, 'w') as fd:
+        json.dump({'commit': rev, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                   'results': results}, fd, indent=2, sort_keys=True)
+    print('saved {}'.format(filename))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+benchmark the memory held by packages and output rows: full package dicts, as fetched from
+CKAN, against the projected dicts and compact records used by the exporters
+
+usage: python benchmarks/bench_records.py [--packages 100000] [--project base]
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bpasubmit.synthetic import synthetic_packages  # noqa: E402
+from bpasubmit.ncbi import SRARow, NCBISRASubtemplate  # noqa: E402
+from bpasubmit.projects.base.submission import BASE  # noqa: E402
+from bpasubmit.projects.mm.submission import MarineMicrobes  # noqa: E402
+
+
+def retained(build):
+    """
+    returns (bytes retained by the result of `build()`, peak bytes allocated while building it)
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--packages', type=int, default=100000)
+    parser.add_argument('--project', choices=('base', 'mm'), default='base')
+    args = parser.parse_args()
+
+    projection = {'base': BASE, 'mm': MarineMicrobes}[args.project].projection
+    n = args.packages
+
+    def sra_values(i):
+        # most SRA values are constants shared by every row; sample_name and library_ID are not
+        values = dict((t, t) for t in NCBISRASubtemplate.fields)
+        values['sample_name'] = '102.100.100/{}'.format(i)
+        values['library_ID'] = '{}_A{}'.format(i, i)
+        return values
+
+    layouts = (
+        ('package dicts, all fields', lambda: list(synthetic_packages(n, args.project))),
+        ('package dicts, projected', lambda: [projection(t) for t in synthetic_packages(n, args.project)]),
+        ('package records', lambda: [projection.record(projection(t)) for t in synthetic_packages(n, args.project)]),
+        ('SRA row dicts', lambda: [sra_values(i) for i in range(n)]),
+        ('SRA row records', lambda: [SRARow(**sra_values(i)) for i in range(n)]),
+    )
+    print('{} x {}'.format(n, args.project))
+    print('{:<28} {:>14} {:>14} {:>10}'.format('layout', 'retained (MB)', 'peak (MB)', 'per item'))
+    for name, build in layouts:
+        current, peak = retained(build)
+        print('{:<28} {:>14.1f} {:>14.1f} {:>9.0f}B'.format(name, current / 2.0 ** 20, peak / 2.0 ** 20, current / float(n)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+benchmark the start up time of the CLI: the wall time of `bpa-submit --version`,
+`bpa-submit --help` and a bare import of bpasubmit.cli, each in a fresh interpreter, against
+that of an interpreter which does nothing. also checks that none of them load the network
+stack or an exporter, and lists the slowest imports of the CLI (from python -X importtime).
+
+results are saved to benchmarks/results/startup-<commit>.json, and with --compare are shown
+against those saved for another commit.
+
+usage: python benchmarks/bench_startup.py [--runs 20] [--imports 10] [--compare COMMIT]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from bench_pipeline import commit, RESULTS_DIR
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules which starting the CLI should not import
+HEAVY = ('requests', 'urllib3', 'ckanapi', 'dateutil', 'orjson', 'ijson',
+         'bpasubmit.transport', 'bpasubmit.projects.base.submission', 'bpasubmit.projects.mm.submission')
+
+RUN_CLI = '''\
+import sys
+sys.argv = ['bpa-submit'] + {argv!r}
+from bpasubmit.cli import main
+try:
+    main()
+except SystemExit:
+    pass
+'''
+
+CHECK = '''
+import sys
+print('\\nheavy:' + ' '.join(t for t in {heavy!r} if t in sys.modules))
+'''
+
+COMMANDS = (
+    ('python', 'pass'),
+    ('import', 'import bpasubmit.cli'),
+    ('--version', RUN_CLI.format(argv=['--version'])),
+    ('--help', RUN_CLI.format(argv=['--help'])),
+)
+
+
+def python(code, *options):
+    # run from the checkout, as python -c puts the working directory first on the path
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run(
+        (sys.executable,) + options + ('-c', code), cwd=ROOT, env=env, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, check=True, universal_newlines=True)
+
+
+def timed(code, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        python(code)
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+
+def heavy_imports(code):
+    output = python(code + CHECK.format(heavy=HEAVY)).stdout
+    return output.rsplit('\nheavy:', 1)[-1].split()
+
+
+def slowest_imports(n):
+    """
+    the `n` imports made by bpasubmit.cli which took longest, including the modules they import
+    """
+    stderr = python('import bpasubmit.cli', '-X', 'importtime').stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name == ' site':
+            # imported by the interpreter, before and whatever the CLI imports
+            imports = []
+            continue
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def load_results(rev):
+    filename = os.path.join(RESULTS_DIR, 'startup-{}.json'.format(rev))
+    if not os.path.exists(filename):
+        sys.exit('no results saved for {}'.format(rev))
+    with open(filename) as fd:
+        return dict((t['command'], t) for t in json.load(fd)['results'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20, help='runs of each command')
+    parser.add_argument('--imports', type=int, default=10, help='number of slowest imports to list')
+    parser.add_argument('--compare', metavar='COMMIT', help='compare with the results saved for this commit')
+    args = parser.parse_args()
+
+    previous = load_results(args.compare) if args.compare else {}
+    rev = commit()
+    results = []
+    print('commit {}'.format(rev))
+    print('{:<10} {:>9} {:>11} {:>9}  {}'.format('command', 'min (ms)', 'median (ms)', 'vs prev', 'heavy imports'))
+    for command, code in COMMANDS:
+        best, median = timed(code, args.runs)
+        heavy = heavy_imports(code)
+        results.append({'command': command, 'min': best, 'median': median, 'heavy_imports': heavy})
+        before = previous.get(command)
+        change = '{:+.0f}%'.format(100.0 * (median / before['median'] - 1)) if before else '-'
+        print('{:<10} {:>9.1f} {:>11.1f} {:>9}  {}'.format(
+            command, best * 1000, median * 1000, change, ' '.join(heavy) or '-'))
+
+    print('\nslowest imports of bpasubmit.cli (cumulative ms):')
+    for cumulative, name in slowest_imports(args.imports):
+        print('{:>9.1f}  {}'.format(cumulative / 1000.0, name))
+
+    if not os.path.isdir(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+    filename = os.path.join(RESULTS_DIR, 'startup-{}.json'.format(rev))
+    with open(filename, 'w') as fd:
+        json.dump({'commit': rev, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                   'results': results}, fd, indent=2, sort_keys=True)
+    print('saved {}'.format(filename))
+
+
+if __name__ == '__main__':
+    main()
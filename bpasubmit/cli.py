@@ -1,19 +1,33 @@
 from __future__ import print_function
 
 import argparse
+import os
 import sys
 
-from .util import make_logger, make_ckan_api
-from .projects.base.submission import BASE
-from .projects.mm.submission import MarineMicrobes
+# only lightweight modules are imported here; the exporters, and the network stack, are
+# imported once the arguments are parsed, so --help and --version return quickly
+from .util import make_logger, set_verbose, run_concurrently, CKAN_FETCH_WORKERS
+from .verify import VERIFY_WORKERS
+from .sinks import COMPRESSIONS, BUFFER_SIZE
+from .profiling import profiler
+from .projects import exporter_names, exporter_args, load_exporter
 
 
 logger = make_logger(__name__)
 
 
 def version():
-    import pkg_resources
-    version = pkg_resources.require("bpasubmit")[0].version
+    try:
+        from importlib.metadata import version as distribution_version, PackageNotFoundError
+    except ImportError:
+        import pkg_resources
+        version = pkg_resources.require("bpasubmit")[0].version
+    else:
+        try:
+            version = distribution_version("bpasubmit")
+        except PackageNotFoundError:
+            # run from a source checkout
+            version = 'unknown'
     print('''\
 bpa-submission-generator, version %s
 
@@ -24,25 +38,119 @@ There is NO WARRANTY, to the extent permitted by law.''' % (version))
     sys.exit(0)
 
 
+class VersionAction(argparse.Action):
+    """
+    print the version as soon as --version is seen, before required arguments are checked
+    """
+
+    def __init__(self, option_strings, dest, **kwargs):
+        super(VersionAction, self).__init__(option_strings, dest, nargs=0, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        version()
+
+
+def address(value):
+    """
+    parse [HOST:]PORT, where HOST defaults to localhost
+    """
+    host, _, port = value.rpartition(':')
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected [HOST:]PORT, not {}'.format(value))
+
+
 def usage(parser):
     parser.print_usage()
     sys.exit(0)
 
 
+def run_exporters(ckan, args, exporters, diagnostics, store=None):
+    """
+    run each of `exporters`, a dict of exporter classes by name, with run_concurrently(),
+    sharing the CKAN session, cache and store, and each with its exporter_args()
+    """
+    def run(name):
+        exporters[name](ckan, exporter_args(args, name, exporters), diagnostics=diagnostics, store=store)
+
+    run_concurrently(run, list(exporters), 'Export')
+
+
 def main():
-    funcs = {
-        'base-ncbi': BASE,
-        'mm-ncbi': MarineMicrobes,
-    }
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--version', action='store_true', help='print version and exit')
+    parser.add_argument('--version', action=VersionAction, help='print version and exit')
     parser.add_argument('-k', '--api-key', required=True, help='CKAN API Key')
     parser.add_argument('-u', '--ckan-url', required=True, help='CKAN base url')
-    parser.add_argument('exporter', choices=funcs.keys())
+    parser.add_argument('--fetch-workers', type=int, default=CKAN_FETCH_WORKERS, help='concurrent page fetches per package type')
+    parser.add_argument('--retries', type=int, default=5, help='retries, with exponential backoff, of failed CKAN requests')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for a CKAN response')
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument('--record', metavar='DIR', help='capture every CKAN response into this directory')
+    recording.add_argument('--replay', metavar='DIR', help='answer CKAN requests from responses captured with --record, offline')
+    parser.add_argument('--store', help='mirror packages in an indexed SQLite database at this path, and query them from there')
+    parser.add_argument('--packing', choices=('ffd', 'ordered'), default='ffd',
+                        help='how samples are packed into submission files: ffd minimises the number of files, '
+                        'ordered keeps them in sample id order')
+    parser.add_argument('-o', '--output-dir', default='output', help='directory to write submission files to')
+    parser.add_argument('--write-workers', type=int, default=1,
+                        help='processes used to write submission files (default: write them in this process)')
+    parser.add_argument('--compress', choices=COMPRESSIONS,
+                        help='compress each submission file as it is written (zstd requires the zstandard package)')
+    parser.add_argument('--archive', action='store_true',
+                        help='package the files of each exporter into a single tar archive, compressed with --compress, '
+                        'with its md5 alongside')
+    parser.add_argument('--write-buffer', type=float, default=BUFFER_SIZE / float(1 << 20),
+                        help='size of the write buffer of each file, in MB')
+    parser.add_argument('--verify-md5', action='store_true',
+                        help='download each resource to be submitted and check its md5, dropping those which do not match')
+    parser.add_argument('--verify-workers', type=int, default=VERIFY_WORKERS, help='concurrent downloads when verifying md5s')
+    parser.add_argument('--verify-bandwidth', type=float, default=0,
+                        help='cap on the combined download rate when verifying md5s, in MB/s (default: no cap)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only write samples which are new, or have changed, since the last incremental run, '
+                        'into a new batch directory within the output directory')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write the wall and CPU time, peak RSS and record count of each stage to this JSON file')
+    parser.add_argument('--cprofile', metavar='STAGES', type=lambda t: t.split(','), default=(),
+                        help='comma separated stages (for example: grouping,sra_rows,write) to also run under '
+                        'cProfile, dumping their stats alongside the --profile file')
+    parser.add_argument('--serve', metavar='[HOST:]PORT', type=address,
+                        help='run as a service: keep the packages in memory, poll CKAN for changes, and serve '
+                        'an HTTP API (on localhost, unless HOST is given) to plan and run exports')
+    parser.add_argument('--poll-interval', type=float, default=300,
+                        help='with --serve, seconds between polls of CKAN for changed packages')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log each skipped or renamed record')
+    parser.add_argument('--report', help='write a report of skipped records to this path (.json, or .tsv)')
+    parser.add_argument('exporter', nargs='+', choices=exporter_names() + ['all'],
+                        help='exporters to run; with more than one, each writes to a subdirectory of the output directory')
 
     args = parser.parse_args()
-    if args.version:
-        version()
-    ckan = make_ckan_api(args)
-    funcs[args.exporter](ckan, args)
+    if args.serve and (args.store or args.report):
+        parser.error('--serve keeps packages in memory, and does not support --store or --report')
+    set_verbose(args.verbose)
+    if args.profile:
+        profiler.configure(cprofile=args.cprofile, dump_dir=os.path.dirname(os.path.abspath(args.profile)))
+
+    from .util import make_ckan_api
+    from .diagnostics import Diagnostics
+    from .store import PackageStore
+
+    names = exporter_names() if 'all' in args.exporter else sorted(set(args.exporter))
+    exporters = dict((name, load_exporter(name)) for name in names)
+    ckan = make_ckan_api(
+        args, concurrent_types=sum(len(t.package_types) for t in exporters.values()),
+        downloads=args.verify_workers * len(exporters) if args.verify_md5 else 0)
+    if args.serve:
+        from .service import Service
+        Service(ckan, args, exporters, poll_interval=args.poll_interval).serve(*args.serve)
+    else:
+        store = PackageStore(args.store) if args.store else None
+        diagnostics = Diagnostics()
+        run_exporters(ckan, args, exporters, diagnostics, store=store)
+        if args.report:
+            diagnostics.write(args.report)
+    logger.info('CKAN transport: {}'.format(ckan.session.stats.summary()))
+    if args.profile:
+        profiler.write(args.profile)
@@ -0,0 +1,52 @@
+import csv
+import json
+import threading
+
+from .util import make_logger
+
+
+logger = make_logger(__name__)
+
+
+class Diagnostics(object):
+    """
+    collects what was skipped during a run, and why: per project and filter stage, the
+    number of records accepted, and for each reason the number skipped along with a bounded
+    sample of example ids. written out as a machine-readable report at the end of the run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = []
+
+    def add(self, project, pipeline):
+        """
+        record the outcome of a FilterPipeline which has been run
+        """
+        stage = {
+            'project': project,
+            'stage': pipeline.name,
+            'accepted': pipeline.accepted,
+            'skipped': [
+                {'reason': reason, 'count': count, 'examples': list(pipeline.examples.get(reason, ()))}
+                for reason, count in sorted(pipeline.tally.items())],
+        }
+        with self._lock:
+            self.stages.append(stage)
+
+    def write(self, filename):
+        """
+        write the report to `filename`: TSV if it ends in .tsv, otherwise JSON
+        """
+        stages = sorted(self.stages, key=lambda t: (t['project'], t['stage']))
+        with open(filename, 'w') as fd:
+            if filename.endswith('.tsv'):
+                writer = csv.writer(fd, dialect='excel-tab')
+                writer.writerow(('project', 'stage', 'reason', 'count', 'examples'))
+                for stage in stages:
+                    writer.writerow((stage['project'], stage['stage'], 'accepted', stage['accepted'], ''))
+                    for t in stage['skipped']:
+                        writer.writerow((stage['project'], stage['stage'], t['reason'], t['count'], ','.join(str(e) for e in t['examples'])))
+            else:
+                json.dump({'stages': stages}, fd, indent=2, sort_keys=True)
+        logger.info('Wrote diagnostics report: {}'.format(filename))
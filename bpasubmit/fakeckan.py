@@ -0,0 +1,297 @@
+"""
+a lightweight stand-in for the CKAN portal, for exercising the exporters with no network:
+package_search (with paging, sorting, fl and the fq filters the fetch layer uses),
+login_generic, and resource downloads. it serves synthetic packages, or packages loaded
+from a JSON file or a directory of responses captured with `bpa-submit --record`, and can
+add latency, fail a fraction of requests, and throttle the request rate and download
+bandwidth.
+
+usage: python -m bpasubmit.fakeckan [--port 5000] [--packages 10000] [--data FILE_OR_DIR]
+                                    [--latency 0.05] [--error-rate 0.01] [--max-rate 50]
+"""
+from __future__ import print_function
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .util import make_logger
+from .synthetic import synthetic_packages, PROJECT_TYPES
+from .jsonio import read_lines
+
+
+logger = make_logger(__name__)
+
+DOWNLOAD_PATH = re.compile(r'^/dataset/(?P<package_id>[^/]+)/resource/(?P<resource_id>[^/]+)/download/')
+MODIFIED_SINCE = re.compile(r'^metadata_modified:\[(?P<since>\S+) TO \*\]$')
+ID_IN = re.compile(r'^id:\((?P<ids>.*)\)$')
+LOGIN_PAGE = '<html><body><form><input id="field-login" name="login"></form></body></html>'
+
+
+def load_packages(path):
+    """
+    packages from a line-delimited JSON file of packages (such as a cache/ file), a JSON list
+    of packages, or the package_search responses in a directory captured with `bpa-submit --record`
+    """
+    if path.endswith('.jsonl'):
+        return list(read_lines(path))
+    if not os.path.isdir(path):
+        with open(path) as fd:
+            return json.load(fd)
+    by_id = {}
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(path, filename)) as fd:
+            entry = json.load(fd)
+        if '/package_search' not in entry['url']:
+            continue
+        for package in json.loads(entry['body'])['result']['results']:
+            # listings of ids alone, made to detect deletions, carry nothing else
+            if len(package) > 1:
+                by_id[package['id']] = package
+    return list(by_id.values())
+
+
+def resource_content(resource_id, size):
+    """
+    the deterministic content served for a resource
+    """
+    block = hashlib.sha256(resource_id.encode('utf8')).hexdigest().encode('ascii') * 64
+    return (block * (size // len(block) + 1))[:size]
+
+
+class FakeCKANServer(object):
+    """
+    serves `packages` as CKAN would. responses are delayed by `latency` seconds, a fraction
+    `error_rate` of requests fail with a 503, requests beyond `max_rate` a second are turned
+    away with a 503 and Retry-After, and downloads are capped at `bandwidth` bytes a second.
+
+    the url of each resource is rewritten to download from this server. if `fix_md5` is set,
+    as it is for synthetic packages, each resource's md5 is set to that of the content served.
+    """
+
+    def __init__(self, packages, latency=0.0, error_rate=0.0, max_rate=None, bandwidth=None,
+                 resource_bytes=1 << 16, page_limit=1000, fix_md5=False, credentials=None, seed=0):
+        self.packages = sorted(packages, key=lambda t: t['id'])
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_rate = max_rate
+        self.bandwidth = bandwidth
+        self.resource_bytes = resource_bytes
+        self.page_limit = page_limit
+        self.fix_md5 = fix_md5
+        self.credentials = credentials
+        self.stats = dict((t, 0) for t in ('requests', 'errors', 'throttled', 'downloads'))
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+        self.server = None
+        self.resources = {}
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def _prepare(self):
+        # point every resource at this server
+        for package in self.packages:
+            for resource in package.get('resources', ()):
+                filename = resource.get('url', '').rsplit('/', 1)[-1] or 'file'
+                resource['url'] = '{}/dataset/{}/resource/{}/download/{}'.format(
+                    self.address, package['id'], resource['id'], filename)
+                if self.fix_md5:
+                    resource['md5'] = hashlib.md5(resource_content(resource['id'], self.resource_bytes)).hexdigest()
+                self.resources[resource['id']] = resource
+
+    def admit(self):
+        """
+        returns None if the request should be served, or the status to fail it with
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            if self.max_rate:
+                second = int(time.monotonic())
+                window, count = self._window
+                count = count + 1 if window == second else 1
+                self._window = (second, count)
+                if count > self.max_rate:
+                    self.stats['throttled'] += 1
+                    return 503
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.stats['errors'] += 1
+                return 503
+
+    def package_search(self, params):
+        typ = None
+        q = params.get('q', '')
+        if q.startswith('type:'):
+            typ = q[len('type:'):]
+        selected = [t for t in self.packages if typ is None or t.get('type') == typ]
+        for fq in filter(None, (params.get('fq') or '').split(' AND ')):
+            since = MODIFIED_SINCE.match(fq)
+            ids = ID_IN.match(fq)
+            if since:
+                since = since.group('since').rstrip('Z')
+                selected = [t for t in selected if t.get('metadata_modified', '') >= since]
+            elif ids:
+                wanted = set(ids.group('ids').split(' OR '))
+                selected = [t for t in selected if t['id'] in wanted]
+            else:
+                raise ValueError('unsupported fq: {}'.format(fq))
+        sort = (params.get('sort') or 'id asc').split()
+        if sort[0] != 'id':
+            selected.sort(key=lambda t: t.get(sort[0]) or '')
+        if sort[-1] == 'desc':
+            selected.reverse()
+        start = int(params.get('start') or 0)
+        rows = min(int(params.get('rows') or 10), self.page_limit)
+        results = selected[start:start + rows]
+        fl = params.get('fl')
+        if fl:
+            fields = re.split(r'[\s,]+', fl.strip())
+            results = [dict((k, t[k]) for k in fields if k in t) for t in results]
+        return {'count': len(selected), 'results': results}
+
+    def login(self, form):
+        login, password = form.get('login', [''])[0], form.get('password', [''])[0]
+        if self.credentials is None:
+            return bool(login and password)
+        return self.credentials.get(login) == password
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        serve on a background thread; port 0 picks a free port. returns the server's address
+        """
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self._prepare()
+        thread = threading.Thread(target=self.server.serve_forever, name='fakeckan', daemon=True)
+        thread.start()
+        return self.address
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _handler(ckan):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, fmt, *args):
+            logger.debug('%s %s', self.address_string(), fmt % args)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def _send(self, status, body, content_type='application/json', headers=()):
+            if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                body = gzip.compress(body, compresslevel=1)
+                headers = tuple(headers) + (('Content-Encoding', 'gzip'),)
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in headers:
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _json(self, status, obj):
+            self._send(status, json.dumps(obj).encode('utf8'))
+
+        def _handle(self, body):
+            if ckan.latency:
+                time.sleep(ckan.latency)
+            refused = ckan.admit()
+            if refused:
+                return self._send(refused, b'{"success": false}', headers=(('Retry-After', '1'),))
+            url = urlparse(self.path)
+            if url.path.endswith('/action/package_search'):
+                params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+                if body:
+                    params.update(json.loads(body.decode('utf8')))
+                try:
+                    result = ckan.package_search(params)
+                except ValueError as e:
+                    return self._json(409, {'success': False, 'error': {'__type': 'Search Query Error', 'message': str(e)}})
+                return self._json(200, {'help': 'package_search', 'success': True, 'result': result})
+            if url.path == '/login_generic':
+                if ckan.login(parse_qs(body.decode('utf8'))):
+                    return self._send(200, b'<html>Dashboard</html>', 'text/html', (('Set-Cookie', 'auth_tkt=fake; Path=/'),))
+                return self._send(200, LOGIN_PAGE.encode('utf8'), 'text/html')
+            download = DOWNLOAD_PATH.match(url.path)
+            if download and download.group('resource_id') in ckan.resources:
+                if 'auth_tkt=' not in (self.headers.get('Cookie') or ''):
+                    return self._send(403, b'Unauthorized', 'text/plain')
+                return self._download(download.group('resource_id'))
+            return self._send(404, b'{"success": false}')
+
+        def _download(self, resource_id):
+            with ckan._lock:
+                ckan.stats['downloads'] += 1
+            content = resource_content(resource_id, ckan.resource_bytes)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            chunk = 1 << 16
+            for i in range(0, len(content), chunk):
+                self.wfile.write(content[i:i + chunk])
+                if ckan.bandwidth:
+                    time.sleep(min(chunk, len(content) - i) / float(ckan.bandwidth))
+
+        def do_GET(self):
+            self._handle(b'')
+
+        def do_POST(self):
+            self._handle(self._body())
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--data', help='serve packages from this JSON file, or directory of recorded responses')
+    parser.add_argument('--packages', type=int, default=10000, help='synthetic packages per project, if --data is not given')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to delay each response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests which fail with a 503')
+    parser.add_argument('--max-rate', type=int, help='requests a second served before responding 503, Retry-After')
+    parser.add_argument('--bandwidth', type=float, help='cap on each download, in bytes a second')
+    parser.add_argument('--resource-bytes', type=int, default=1 << 16, help='size of each resource download')
+    parser.add_argument('--page-limit', type=int, default=1000, help='maximum rows returned by package_search')
+    args = parser.parse_args()
+
+    if args.data:
+        packages = load_packages(args.data)
+    else:
+        packages = [package for project in sorted(PROJECT_TYPES) for package in synthetic_packages(args.packages, project)]
+    ckan = FakeCKANServer(
+        packages, latency=args.latency, error_rate=args.error_rate, max_rate=args.max_rate, bandwidth=args.bandwidth,
+        resource_bytes=args.resource_bytes, page_limit=args.page_limit, fix_md5=not args.data)
+    ckan.start(args.host, args.port)
+    logger.info('Serving {} packages at {}'.format(len(ckan.packages), ckan.address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info('Stopped: {}'.format(ckan.stats))
+        ckan.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import logging
+from collections import Counter
+
+from .util import make_logger, embargo_cutoff
+
+
+logger = make_logger(__name__)
+
+
+class Rule(object):
+    """
+    a named filter rule: records for which `test(record)` is false are rejected, with
+    `reason` as the reason they were skipped
+    """
+
+    def __init__(self, reason, test):
+        self.reason = reason
+        self.test = test
+
+    def compile(self):
+        """
+        return the predicate to apply to each record; called once per FilterPipeline
+        """
+        return self.test
+
+
+class EmbargoRule(Rule):
+    """
+    reject records whose archive_ingestion_date is within `months` of today. the cutoff date
+    is computed once, when the rule is compiled, and then compared against each ISO date
+    """
+
+    def __init__(self, reason, months):
+        self.reason = reason
+        self.months = months
+
+    def compile(self):
+        cutoff = embargo_cutoff(self.months)
+
+        def test(record):
+            ingest_date = record.get('archive_ingestion_date')
+            return bool(ingest_date) and ingest_date <= cutoff
+        return test
+
+
+def present(*fields):
+    return lambda record: all(t in record for t in fields)
+
+
+def truthy(field):
+    return lambda record: bool(record.get(field))
+
+
+def falsy(field):
+    return lambda record: not record.get(field)
+
+
+def not_equal(field, value):
+    return lambda record: record.get(field) != value
+
+
+def one_of(field, values):
+    values = frozenset(values)
+    return lambda record: record.get(field) in values
+
+
+def embargo_rules(months):
+    """
+    the rules for excluding packages which are, or may be, under embargo
+    """
+    return (
+        Rule('no archive_ingestion_date', truthy('archive_ingestion_date')),
+        EmbargoRule('embargoed', months),
+    )
+
+
+class FilterPipeline(object):
+    """
+    a set of rules, compiled into a single pass over records. each record is tested
+    against the rules in order; the first it fails is tallied as the reason it was skipped,
+    and the first `examples` ids skipped for each reason are kept.
+
+    a line per skipped record is only logged if debug logging is enabled.
+    """
+
+    def __init__(self, name, rules, examples=10):
+        self.name = name
+        self.rules = tuple(rules)
+        self._tests = tuple((rule.reason, rule.compile()) for rule in self.rules)
+        self.max_examples = examples
+        self.accepted = 0
+        self.tally = Counter()
+        self.examples = {}
+
+    def _skip(self, reason, record, log):
+        self.tally[reason] += 1
+        examples = self.examples.setdefault(reason, [])
+        if len(examples) < self.max_examples:
+            # grouped biosample records have no id when it differs within the group
+            examples.append(record.get('id') or record.get('sample_id'))
+        if log:
+            logger.debug('Skipping (%s) %s id: %s sample_id: %s', reason, self.name, record.get('id'), record.get('sample_id'))
+
+    def filter(self, records):
+        """
+        yield the records which pass every rule
+        """
+        tests = self._tests
+        log = logger.isEnabledFor(logging.DEBUG)
+        for record in records:
+            for reason, test in tests:
+                if not test(record):
+                    self._skip(reason, record, log)
+                    break
+            else:
+                self.accepted += 1
+                yield record
+
+    def run(self, records):
+        """
+        returns (accepted records, tally of rejections by reason)
+        """
+        return list(self.filter(records)), self.tally
+
+    def report(self):
+        logger.info('Filtered {}: accepted {} skipped {}'.format(
+            self.name, self.accepted, ', '.join('{} ({})'.format(k, v) for k, v in sorted(self.tally.items())) or 'none'))
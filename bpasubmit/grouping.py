@@ -0,0 +1,38 @@
+_MISSING = object()
+_UNSET = object()
+
+
+def group_common(packages, key, fields):
+    """
+    group `packages` by `key(package)`, and return a dict per group (in order of first
+    appearance) holding those of `fields` which are present with the same value in every
+    package of the group. values are returned as strings.
+
+    work is done a column at a time, over only the requested fields: each package is
+    assigned its group once, and then each field is reduced across all packages.
+    """
+    group_of = {}
+    membership = []
+    for package in packages:
+        membership.append(group_of.setdefault(key(package), len(group_of)))
+    ngroups = len(group_of)
+
+    records = [{} for _ in range(ngroups)]
+    for field in fields:
+        first = [_UNSET] * ngroups
+        consistent = [True] * ngroups
+        for group, package in zip(membership, packages):
+            value = package.get(field, _MISSING)
+            shared = first[group]
+            if shared is _UNSET:
+                first[group] = value
+            elif value is not shared and not (type(value) is str and type(shared) is str and value == shared):
+                # values are compared as strings, as they always have been: 1 and '1' are the
+                # same, while 150 and 150.0, or True and 1, which compare equal, are not
+                if value is _MISSING or shared is _MISSING or str(value) != str(shared):
+                    consistent[group] = False
+        for group in range(ngroups):
+            value = first[group]
+            if consistent[group] and value is not _MISSING:
+                records[group][field] = str(value)
+    return records
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+from .jsonio import replace_atomic
+from .util import make_logger
+
+
+logger = make_logger(__name__)
+
+
+def row_hash(row, file_info=None):
+    """
+    a content hash of a submission row, and for SRA rows the files it uploads
+    """
+    content = [sorted(row.items())]
+    if file_info is not None:
+        content.append(file_info)
+    return hashlib.md5(json.dumps(content, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def sra_sample_key(row):
+    # rows for samples which already have a BioSample accession have no sample_name
+    return row['sample_name'] or row['biosample_accession']
+
+
+class SubmissionState(object):
+    """
+    the rows emitted for each sample by previous runs, as a sorted list of content hashes
+    per sample, along with the number of the last batch written.
+
+    each incremental run writes only the samples which are new, or whose rows have
+    changed, into a fresh batch directory; earlier batches are left untouched.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.batch = 0
+        self.samples = {}
+        self._changed = {}
+        if os.path.exists(filename):
+            with open(filename) as fd:
+                state = json.load(fd)
+            self.batch = state['batch']
+            self.samples = state['samples']
+
+    def batch_dir(self, output_dir):
+        """
+        the directory the next batch is written to
+        """
+        return os.path.join(output_dir, 'batch-{:04d}'.format(self.batch + 1))
+
+    def select_changed(self, biosample_rows, index):
+        """
+        returns the BioSample rows of new or changed samples, and drops the SRA rows of
+        unchanged samples from `index`. the hashes of the changed samples are held until
+        commit() is called.
+        """
+        hashes = {}
+        for row in biosample_rows:
+            hashes.setdefault(row['sample_name'], []).append(row_hash(row))
+        for sample_name, rows in index.sra_rows.items():
+            hashes.setdefault(sample_name, []).extend(row_hash(row, file_info) for row, file_info in rows)
+        for row, file_info in index.sra_existing:
+            hashes.setdefault(sra_sample_key(row), []).append(row_hash(row, file_info))
+
+        self._changed = {}
+        for sample, sample_hashes in hashes.items():
+            sample_hashes.sort()
+            if self.samples.get(sample) != sample_hashes:
+                self._changed[sample] = sample_hashes
+        changed = self._changed
+        logger.info('Samples changed since batch {}: {} of {}'.format(self.batch, len(changed), len(hashes)))
+
+        index.sra_rows = OrderedDict((k, v) for k, v in index.sra_rows.items() if k in changed)
+        index.sra_existing = [t for t in index.sra_existing if sra_sample_key(t[0]) in changed]
+        return [row for row in biosample_rows if row['sample_name'] in changed]
+
+    def commit(self):
+        """
+        record the changed samples as emitted in a new batch, and save the state
+        """
+        self.batch += 1
+        self.samples.update(self._changed)
+        replace_atomic(
+            self.filename, lambda fd: json.dump({'batch': self.batch, 'samples': self.samples}, fd, sort_keys=True),
+            mode='w')
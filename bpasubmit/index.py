@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+from .util import sample_id_short
+
+
+def sample_num(sample_id):
+    """
+    the numeric part of a sample id, which submissions are ordered by
+    """
+    return int(sample_id_short(sample_id))
+
+
+class PackageIndex(object):
+    """
+    built once per run over a project's packages, or by the service each time they change.
+    each package's numeric sample id is computed once, and the packages are kept in sample
+    id order (ties keep their input order). the SRA rows built from the packages can be
+    added, and then looked up by sample_name.
+
+    later stages take their ordering from here, rather than re-sorting or re-scanning.
+    """
+
+    def __init__(self, packages):
+        self._sample_nums = {}
+        keyed = [(self.sample_num(package['sample_id']), package) for package in packages]
+        keyed.sort(key=lambda t: t[0])
+        self._packages = [package for _, package in keyed]
+        self.sra_rows = OrderedDict()
+        self.sra_existing = []
+
+    def sample_num(self, sample_id):
+        try:
+            return self._sample_nums[sample_id]
+        except KeyError:
+            num = self._sample_nums[sample_id] = sample_num(sample_id)
+            return num
+
+    def __len__(self):
+        return len(self._packages)
+
+    def by_sample_id(self):
+        return self._packages
+
+    def add_sra_rows(self, sra_rows):
+        """
+        index (row, file info) pairs by sample_name. rows for samples which already have a
+        BioSample accession have no sample_name, and are kept aside in sra_existing.
+        """
+        for row_res in sra_rows:
+            sample_name = row_res[0]['sample_name']
+            if not sample_name:
+                self.sra_existing.append(row_res)
+            else:
+                self.sra_rows.setdefault(sample_name, []).append(row_res)
+        # rows built from by_sample_id() arrive in order, so this only sorts rows from elsewhere
+        nums = [self.sample_num(t) for t in self.sra_rows]
+        if any(a > b for a, b in zip(nums, nums[1:])):
+            self.sra_rows = OrderedDict(sorted(self.sra_rows.items(), key=lambda kv: self.sample_num(kv[0])))
+
+    def clear_sra_rows(self):
+        """
+        drop the SRA rows added, so that rows can be built from the packages again
+        """
+        self.sra_rows = OrderedDict()
+        self.sra_existing = []
+
+    def sra_rows_for(self, sample_name):
+        return self.sra_rows.get(sample_name, [])
@@ -0,0 +1,150 @@
+"""
+JSON decoding and encoding for the fetch and cache layers. orjson is used when it is
+installed, and ijson to decode package_search responses one package at a time; both are
+optional, and the standard library is used in their absence. they are imported on first
+use, rather than with this module, which the CLI loads on every invocation.
+
+replace_atomic() is how every file, of the cache or of the output, is written.
+"""
+import json
+import os
+
+
+_backends = None
+
+
+def backends():
+    """
+    (orjson, ijson), either None if it is not installed
+    """
+    global _backends
+    if _backends is None:
+        try:
+            import orjson
+        except ImportError:
+            orjson = None
+        try:
+            import ijson
+        except ImportError:
+            ijson = None
+        _backends = (orjson, ijson)
+    return _backends
+
+
+def loads(data):
+    orjson = backends()[0]
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """
+    compact JSON, as bytes
+    """
+    orjson = backends()[0]
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+
+def read_lines(filename):
+    """
+    yield each object in the line-delimited JSON file `filename`, decoding one line at a time
+    """
+    with open(filename, 'rb') as fd:
+        for line in fd:
+            if line.strip():
+                yield loads(line)
+
+
+def replace_atomic(filename, write, mode='wb', buffering=-1):
+    """
+    call write(fd) on a temporary file alongside `filename`, then move it into place, and
+    return what write() does. an interrupted write leaves `filename` as it was, and no
+    temporary file behind. the temporary file is named for the process, so that processes
+    writing the same file do not write over each other's.
+    """
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp_filename, mode, buffering=buffering) as fd:
+            result = write(fd)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+    return result
+
+
+def write_lines(filename, objs):
+    """
+    write `objs` to `filename` as line-delimited JSON, one object at a time
+    """
+    def write(fd):
+        for obj in objs:
+            fd.write(dumps(obj))
+            fd.write(b'\n')
+
+    replace_atomic(filename, write)
+
+
+class SearchError(Exception):
+    pass
+
+
+class DecodeError(Exception):
+    """
+    a response body which could not be decoded, most often because it was cut short
+    """
+    pass
+
+
+def search_results(fd, transform=None):
+    """
+    decode the package_search response in the binary file `fd`, returning (count, results),
+    with each package passed through `transform` if given. with ijson, packages are built
+    and transformed one at a time as the response is parsed, so no more than one full
+    package is held at once.
+    """
+    ijson = backends()[1]
+    if ijson is None:
+        try:
+            response = loads(fd.read())
+        except ValueError as e:
+            raise DecodeError('package_search response could not be decoded: {}'.format(e))
+        if not response.get('success'):
+            raise SearchError('package_search failed: {}'.format(response.get('error')))
+        results = response['result']['results']
+        if transform is not None:
+            results = [transform(t) for t in results]
+        return response['result']['count'], results
+
+    count = None
+    results = []
+    success = False
+    builder = None
+    try:
+        for prefix, event, value in ijson.parse(fd, use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if event in ('start_map', 'start_array'):
+                    depth += 1
+                elif event in ('end_map', 'end_array'):
+                    depth -= 1
+                    if depth == 0:
+                        results.append(transform(builder.value) if transform is not None else builder.value)
+                        builder = None
+            elif prefix == 'result.results.item' and event == 'start_map':
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                depth = 1
+            elif prefix == 'result.count':
+                count = value
+            elif prefix == 'success':
+                success = value
+    except ijson.JSONError as e:
+        raise DecodeError('package_search response could not be decoded: {}'.format(e))
+    if not success or count is None:
+        raise SearchError('package_search failed')
+    return count, results
@@ -1,8 +1,18 @@
 
-from collections import Counter
-from .srasubtemplate import NCBISRASubtemplate
-from .biosample import NCBIBioSampleMetagenomeEnvironmental
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from .srasubtemplate import NCBISRASubtemplate, SRARow
+from .biosample import NCBIBioSampleMetagenomeEnvironmental, BioSampleRow, BIOSAMPLE_CUSTOM_FIELDS
+from ..util import make_logger
+from ..profiling import stage
+from ..index import PackageIndex
+from ..sinks import FileSink
 import itertools
+import json
+import os
+
+logger = make_logger(__name__)
 
 
 # from itertools docs
@@ -11,47 +21,221 @@ def grouper(iterable, n, fillvalue=None):
     return itertools.zip_longest(*args, fillvalue=fillvalue)
 
 
-def write_sra_biosample(biosample_custom_fields, biosample_base, biosample_rows, sra_custom_fields, sra_base, sra_rows):
-    #
-    # write out the BioSample and SRA submission files, with a one to one link between each BioSample
-    # file and a corresponding SRA file. In practice this means that BioSample files will tend to be
-    # short.
-    #
+def _pack_ordered(samples, sample_nsrarows, sample_nbiosamplerows, sra_limit, biosample_limit):
+    # next-fit, in numeric sample id order: a new chunk starts whenever the next sample won't fit
+    chunks = []
+    current_chunk = None
+    for sample_id in samples:
+        nsra, nbiosample = sample_nsrarows[sample_id], sample_nbiosamplerows[sample_id]
+        if current_chunk is None or sra_count + nsra > sra_limit or biosample_count + nbiosample > biosample_limit:
+            current_chunk = []
+            chunks.append(current_chunk)
+            sra_count = biosample_count = 0
+        current_chunk.append(sample_id)
+        sra_count += nsra
+        biosample_count += nbiosample
+    return chunks
 
-    # coalesce so we can slice and dice
-    biosample_rows = list(biosample_rows)
-    sra_rows = list(sra_rows)
 
-    sample_nsrarows = Counter(row['sample_name'] for row, _ in sra_rows if row['sample_name'])
+def _pack_first_fit_decreasing(samples, sample_nsrarows, sample_nbiosamplerows, sra_limit, biosample_limit):
+    # first-fit decreasing: place samples largest first, each into the first chunk with room
+    chunks = []
+    # [sra rows free, biosample rows free, samples], for chunks which still have room in both
+    open_chunks = []
+    for sample_id in sorted(samples, key=lambda t: (-sample_nsrarows[t], -sample_nbiosamplerows[t])):
+        nsra, nbiosample = sample_nsrarows[sample_id], sample_nbiosamplerows[sample_id]
+        for i, chunk in enumerate(open_chunks):
+            if nsra <= chunk[0] and nbiosample <= chunk[1]:
+                break
+        else:
+            i, chunk = len(open_chunks), [sra_limit, biosample_limit, []]
+            open_chunks.append(chunk)
+            chunks.append(chunk[2])
+        chunk[0] -= nsra
+        chunk[1] -= nbiosample
+        chunk[2].append(sample_id)
+        if chunk[0] <= 0 or chunk[1] <= 0:
+            del open_chunks[i]
+    # keep each file in sample id order, and number the files in order of their first sample
+    position = dict((sample_id, i) for i, sample_id in enumerate(samples))
+    chunks = [sorted(chunk, key=position.__getitem__) for chunk in chunks]
+    chunks.sort(key=lambda chunk: position[chunk[0]])
+    return chunks
+
+
+PACKINGS = {
+    'ffd': _pack_first_fit_decreasing,
+    'ordered': _pack_ordered,
+}
+
+
+def plan_sra_chunks(index, biosample_rows=(), packing='ffd'):
+    """
+    bin the samples which have new SRA rows into chunks, each of which will become a
+    BioSample and an SRA submission file. a sample's SRA rows are kept together, and no
+    chunk has more than NCBISRASubtemplate.chunk_size SRA rows or more than
+    NCBIBioSampleMetagenomeEnvironmental.chunk_size BioSample rows, unless a single
+    sample requires it.
+
+    `packing` is one of:
+      'ffd': first-fit decreasing, which minimises the number of chunks
+      'ordered': fill chunks in numeric sample id order, keeping neighbouring samples together
+
+    the SRA rows are taken from `index`, a PackageIndex they have been added to.
+    returns a list of lists of sample names.
+    """
+    sra_limit = NCBISRASubtemplate.chunk_size
+    biosample_limit = NCBIBioSampleMetagenomeEnvironmental.chunk_size
+
+    # the index holds samples in numeric sample id order
+    sample_nsrarows = dict((sample_id, len(rows)) for sample_id, rows in index.sra_rows.items())
+    sample_nbiosamplerows = Counter(row['sample_name'] for row in biosample_rows if row['sample_name'] in sample_nsrarows)
+    samples = list(sample_nsrarows)
+    for sample_id in samples:
+        if sample_nsrarows[sample_id] > sra_limit or sample_nbiosamplerows[sample_id] > biosample_limit:
+            logger.warn('Oversized sample (chunk limits) sample_id: {} sra rows: {} biosample rows: {}'.format(
+                sample_id, sample_nsrarows[sample_id], sample_nbiosamplerows[sample_id]))
+
+    return PACKINGS[packing](samples, sample_nsrarows, sample_nbiosamplerows, sra_limit, biosample_limit)
+
+
+def partition_rows(sra_chunks, biosample_rows, index):
+    """
+    distribute BioSample rows to the chunk holding their sample in a single pass, and look
+    up the SRA rows for each chunk's samples in `index`. returns (biosample rows per chunk,
+    SRA rows per chunk, SRA rows for existing samples); rows keep their original order
+    within each chunk.
+    """
+    chunk_of = {}
+    for chunk_num, sample_ids in enumerate(sra_chunks):
+        for sample_id in sample_ids:
+            chunk_of[sample_id] = chunk_num
+
+    biosample_chunks = [[] for _ in sra_chunks]
+    for row in biosample_rows:
+        chunk_num = chunk_of.get(row['sample_name'])
+        if chunk_num is not None:
+            biosample_chunks[chunk_num].append(row)
+
+    sra_chunk_rows = [
+        [row_res for sample_id in sample_ids for row_res in index.sra_rows_for(sample_id)]
+        for sample_ids in sra_chunks]
+
+    return biosample_chunks, sra_chunk_rows, index.sra_existing
+
+
+def _pool_context():
+    # the caller runs exporters, or a service, on threads: forking a threaded process is
+    # unsafe, so workers are started from a clean server process, or spawned
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _write_chunk_files(sink, jobs, workers):
+    """
+    render each of `jobs` with `sink`, in this process, or on a pool of `workers`
+    processes; yields the results in order
+    """
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=_pool_context()) as executor:
+            for result in executor.map(sink.write, *zip(*jobs)):
+                yield result
+    else:
+        for job in jobs:
+            yield sink.write(*job)
+
+
+def plan_submission(biosample_custom_fields, biosample_base, biosample_rows, sra_custom_fields, sra_base, sra_rows,
+                    packing='ffd', output_dir='output', index=None, state=None):
+    """
+    bin the rows into submission files, as write_sra_biosample() does, without writing
+    them. returns (output_dir, files): the directory the files are to be written to (the
+    next batch directory, if `state` is given), and for each file a tuple of (writer,
+    custom fields, filename, rows, samples). files is None if `state` finds nothing
+    has changed.
+    """
+    # coalesce so we can slice and dice
+    with stage('biosample_rows') as measured:
+        biosample_rows = list(biosample_rows)
+        measured.count = len(biosample_rows)
+    if index is None:
+        index = PackageIndex(())
+    with stage('sra_rows') as measured:
+        index.add_sra_rows(sra_rows)
+        measured.count = sum(len(t) for t in index.sra_rows.values()) + len(index.sra_existing)
+    if state is not None:
+        with stage('incremental'):
+            biosample_rows = state.select_changed(biosample_rows, index)
+        if not biosample_rows and not index.sra_rows and not index.sra_existing:
+            return output_dir, None
+        output_dir = state.batch_dir(output_dir)
 
     # bin samples into SRA template files where new samples are being uploaded
-    current_chunk = []
-    sra_chunks = [current_chunk]
-    counter = 0
-    for sample_id, srarows in sorted(sample_nsrarows.items(), key=lambda kv: int(kv[0].split('/', 1)[-1])):
-        if counter + srarows > NCBISRASubtemplate.chunk_size:
-            current_chunk = []
-            sra_chunks.append(current_chunk)
-            counter = 0
-        current_chunk.append(sample_id)
-        counter += srarows
-
-    # For each chunk, write out the BioSample and SRA templates
-    for output_filenum, sample_ids in enumerate(sra_chunks, start=1):
-        br = [row for row in biosample_rows if row['sample_name'] in sample_ids]
-        biosample_filename = 'output/{}-{}.tsv'.format(biosample_base, output_filenum)
-        with open(biosample_filename, 'w') as fd:
-            NCBIBioSampleMetagenomeEnvironmental.write(biosample_custom_fields, fd, br)
-
-        sr = [row_res for row_res in sra_rows if row_res[0]['sample_name'] in sample_ids]
-        sra_filename = 'output/{}-{}.tsv'.format(sra_base, output_filenum)
-        with open(sra_filename, 'w') as fd:
-            NCBISRASubtemplate.write(sra_custom_fields, fd, sr)
-
-    # Spit out the file uploads for the existing samples
-    sra_existing = [t for t in sra_rows if not t[0]['sample_name']]
+    with stage('plan') as measured:
+        sra_chunks = plan_sra_chunks(index, biosample_rows, packing=packing)
+        biosample_chunks, sra_chunk_rows, sra_existing = partition_rows(sra_chunks, biosample_rows, index)
+        measured.count = len(sra_chunks)
+
+    # For each chunk, a BioSample and an SRA template
+    files = []
+    for output_filenum, (samples, br, sr) in enumerate(zip(sra_chunks, biosample_chunks, sra_chunk_rows), start=1):
+        biosample_filename = os.path.join(output_dir, '{}-{}.tsv'.format(biosample_base, output_filenum))
+        files.append((NCBIBioSampleMetagenomeEnvironmental, biosample_custom_fields, biosample_filename, br, samples))
+        sra_filename = os.path.join(output_dir, '{}-{}.tsv'.format(sra_base, output_filenum))
+        files.append((NCBISRASubtemplate, sra_custom_fields, sra_filename, sr, samples))
+
+    # Then the file uploads for the existing samples, which are named by their accession
     for output_filenum, sr in enumerate(grouper(sra_existing, NCBISRASubtemplate.chunk_size), start=1):
         sr = [t for t in sr if t]
-        sra_filename = 'output/{}-SA{}.tsv'.format(sra_base, output_filenum)
-        with open(sra_filename, 'w') as fd:
-            NCBISRASubtemplate.write(sra_custom_fields, fd, sr)
+        samples = list(OrderedDict.fromkeys(row['biosample_accession'] for row, _ in sr))
+        sra_filename = os.path.join(output_dir, '{}-SA{}.tsv'.format(sra_base, output_filenum))
+        files.append((NCBISRASubtemplate, sra_custom_fields, sra_filename, sr, samples))
+
+    return output_dir, files
+
+
+def write_sra_biosample(biosample_custom_fields, biosample_base, biosample_rows, sra_custom_fields, sra_base, sra_rows,
+                        packing='ffd', output_dir='output', workers=1, manifest_filename=None, index=None, state=None,
+                        sink=None):
+    #
+    # write out the BioSample and SRA submission files, with a one to one link between each BioSample
+    # file and a corresponding SRA file. In practice this means that BioSample files will tend to be
+    # short.
+    #
+    # files are rendered on a pool of `workers` processes, and each is only moved into `output_dir`
+    # once complete. a manifest of the files written, their row counts and checksums is then
+    # written to `manifest_filename` within `output_dir`.
+    #
+    # SRA rows are looked up by sample through `index`, the PackageIndex of the packages
+    # they were built from.
+    #
+    # if `state` (a SubmissionState) is given, only new or changed samples are written, into
+    # the next batch directory within `output_dir`.
+    #
+    # files are written by `sink` (see sinks.py), by default a FileSink writing uncompressed
+    # files into `output_dir`.
+    #
+    output_dir, files = plan_submission(
+        biosample_custom_fields, biosample_base, biosample_rows, sra_custom_fields, sra_base, sra_rows,
+        packing=packing, output_dir=output_dir, index=index, state=state)
+    if files is None:
+        logger.info('No samples changed since batch {}, nothing written'.format(state.batch))
+        return []
+    jobs = [t[:4] for t in files]
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if sink is None:
+        sink = FileSink()
+    with stage('write') as measured:
+        with sink.open(output_dir) as out:
+            manifest = [out.add(result) for result in _write_chunk_files(sink, jobs, workers)]
+            measured.count = sum(t['rows'] for t in manifest)
+            for entry in manifest:
+                logger.info('Wrote {filename} rows: {rows} md5: {md5}'.format(**entry))
+            if manifest_filename is not None:
+                out.add_file(manifest_filename, json.dumps(manifest, indent=2, sort_keys=True).encode('utf8'))
+    if state is not None:
+        state.commit()
+    return manifest
@@ -1,6 +1,7 @@
 
 import csv
 from ..util import make_logger
+from ..records import record_type
 
 logger = make_logger(__name__)
 
@@ -46,7 +47,7 @@ class NCBIBioSampleMetagenomeEnvironmental(object):
         """
         write NCBI BioSample Metagenome or Environmental; version 1.0 submission sheet to `fd`
         each row in `rows` must be a dictionary with keys corresponding to the fields member of
-        this class, plus any `custom_fields` provided
+        this class, plus any `custom_fields` provided. returns the number of rows written.
         """
         # note: the NCBI template uses DOS linefeeds
         fd.write(cls.ncbi_template.replace('\n', '\r\n'))
@@ -54,3 +55,10 @@ class NCBIBioSampleMetagenomeEnvironmental(object):
         fd.write('\r\n')
         writer = csv.DictWriter(fd, cls.fields + custom_fields, dialect='excel-tab')
         writer.writerows(rows)
+        return len(rows)
+
+
+# the custom fields our projects add to the template, and a BioSample row including them
+BIOSAMPLE_CUSTOM_FIELDS = ('depth', 'isolate')
+BioSampleRow = record_type(
+    'BioSampleRow', NCBIBioSampleMetagenomeEnvironmental.fields + BIOSAMPLE_CUSTOM_FIELDS, module=__name__)
@@ -1,6 +1,7 @@
 
 import csv
 from ..util import make_logger
+from ..records import record_type
 
 logger = make_logger(__name__)
 
@@ -43,11 +44,12 @@ class NCBISRASubtemplate(object):
     @classmethod
     def write(cls, custom_fields, fd, rows):
         """
-        write NCBI SRA Subtemplate v2.8
+        write NCBI SRA Subtemplate v2.8, returning the number of rows written
         """
         # note: the NCBI template uses DOS linefeeds
         writer = csv.writer(fd, dialect='excel-tab')
         writer.writerow(cls.fields + cls.numbered_file_header(4))
+        written = 0
         for row_obj, file_objs in rows:
             if not file_objs:
                 continue
@@ -55,3 +57,8 @@ class NCBISRASubtemplate(object):
             for file_obj in sorted(file_objs):
                 row += file_obj
             writer.writerow(row)
+            written += 1
+        return written
+
+
+SRARow = record_type('SRARow', NCBISRASubtemplate.fields, module=__name__)
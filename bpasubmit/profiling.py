@@ -0,0 +1,131 @@
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# util imports this module, so the logger is not made with util.make_logger
+logger = logging.getLogger(__name__)
+
+
+def peak_rss():
+    """
+    the peak resident set size of this process so far, in bytes
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Stage(object):
+    """
+    the measurements of one run of a stage. code within the stage sets `count` to the
+    number of records it produced.
+    """
+    __slots__ = ('name', 'thread', 'start', 'wall', 'cpu', 'peak_rss', 'count')
+
+    def __init__(self, name, count=None):
+        self.name = name
+        self.thread = threading.current_thread().name
+        self.start = self.wall = self.cpu = self.peak_rss = None
+        self.count = count
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+class Profiler(object):
+    """
+    records the wall time, process CPU time, peak RSS and record count of each stage of a
+    run. stages run concurrently on their own threads (fetches, exporters), and may be
+    nested, so their times overlap and are not to be summed. cpu is the CPU time of the
+    whole process while the stage ran.
+
+    disabled by default, in which case stages cost next to nothing. the stages named in
+    `cprofile` are also run under cProfile, and their stats dumped into `dump_dir`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enabled = False
+        self.cprofile = frozenset()
+        self.dump_dir = None
+        self.reset()
+
+    def configure(self, enabled=True, cprofile=(), dump_dir='.'):
+        self.enabled = enabled
+        self.cprofile = frozenset(cprofile)
+        self.dump_dir = dump_dir
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.stages = []
+
+    @contextmanager
+    def stage(self, name, count=None):
+        measured = Stage(name, count)
+        if not self.enabled:
+            yield measured
+            return
+        profile = None
+        if name in self.cprofile:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is already active on this thread
+                profile = None
+        wall, cpu = time.perf_counter(), time.process_time()
+        measured.start = time.time() - self.started
+        try:
+            yield measured
+        finally:
+            measured.wall = time.perf_counter() - wall
+            measured.cpu = time.process_time() - cpu
+            measured.peak_rss = peak_rss()
+            if profile is not None:
+                profile.disable()
+                self._dump(measured, profile)
+            with self._lock:
+                self.stages.append(measured)
+
+    def _dump(self, measured, profile):
+        if not os.path.isdir(self.dump_dir):
+            os.makedirs(self.dump_dir)
+        filename = os.path.join(self.dump_dir, '{}-{}.pstats'.format(measured.name, measured.thread))
+        profile.dump_stats(filename)
+        logger.info('Wrote profile of stage {} ({}): {}'.format(measured.name, measured.thread, filename))
+
+    def summary(self):
+        """
+        returns the stages measured so far, in the order they finished, along with the
+        elapsed time and peak RSS of the whole run
+        """
+        with self._lock:
+            stages = [t.to_dict() for t in self.stages]
+        return {
+            'elapsed': time.time() - self.started,
+            'peak_rss': peak_rss(),
+            'stages': stages,
+        }
+
+    def write(self, filename):
+        with open(filename, 'w') as fd:
+            json.dump(self.summary(), fd, indent=2, sort_keys=True)
+        logger.info('Wrote profile: {}'.format(filename))
+
+
+# the profiler used throughout a run
+profiler = Profiler()
+stage = profiler.stage
@@ -0,0 +1,71 @@
+"""
+the registry of exporters. each is named, and found by the import path of its class, so
+that only the exporters selected for a run are imported. other packages can add exporters
+under the `bpasubmit.exporters` entry point group, for example:
+
+    entry_points={'bpasubmit.exporters': ['myproject-ncbi = myproject.submission:MyProject']}
+"""
+import argparse
+import importlib
+import os
+
+
+ENTRY_POINT_GROUP = 'bpasubmit.exporters'
+
+# the exporters shipped with bpasubmit, available whether or not it is installed
+EXPORTERS = {
+    'base-ncbi': 'bpasubmit.projects.base.submission:BASE',
+    'mm-ncbi': 'bpasubmit.projects.mm.submission:MarineMicrobes',
+}
+
+_registry = None
+
+
+def _entry_points():
+    try:
+        from importlib import metadata
+    except ImportError:
+        return ()
+    try:
+        return metadata.entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:
+        # before python 3.10, entry_points() takes no arguments and returns a dict
+        return metadata.entry_points().get(ENTRY_POINT_GROUP, ())
+
+
+def registry():
+    """
+    the import path of each exporter, by name. exporters registered as entry points are
+    listed, but not imported.
+    """
+    global _registry
+    if _registry is None:
+        exporters = dict(EXPORTERS)
+        for entry_point in _entry_points():
+            exporters.setdefault(entry_point.name, entry_point.value)
+        _registry = exporters
+    return _registry
+
+
+def exporter_names():
+    return sorted(registry())
+
+
+def exporter_args(args, name, names):
+    """
+    the arguments to run the exporter `name` with, as one of the exporters `names`: when
+    there is more than one, each writes to a subdirectory of args.output_dir named for it
+    """
+    if len(names) <= 1:
+        return args
+    exporter_args = argparse.Namespace(**vars(args))
+    exporter_args.output_dir = os.path.join(args.output_dir, name)
+    return exporter_args
+
+
+def load_exporter(name):
+    """
+    import, and return the class of, the exporter `name`
+    """
+    module_name, _, attr = registry()[name].partition(':')
+    return getattr(importlib.import_module(module_name), attr)
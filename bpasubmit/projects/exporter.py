@@ -0,0 +1,273 @@
+import os
+
+from ..util import make_logger, ckan_packages_of_type, run_concurrently, authenticated_ckan_session
+from ..ncbi import write_sra_biosample, plan_submission, BioSampleRow, SRARow, BIOSAMPLE_CUSTOM_FIELDS
+from ..store import PackageStore
+from ..grouping import group_common
+from ..index import PackageIndex
+from ..diagnostics import Diagnostics
+from ..profiling import stage
+from ..incremental import SubmissionState
+from ..sinks import make_sink
+from ..verify import MD5Verifier, verification_rules
+from ..filters import FilterPipeline, Rule, truthy, not_equal, one_of
+from .spec import compile_builder, spec_fields
+
+logger = make_logger(__name__)
+
+
+class NCBIExporter(object):
+    """
+    exports a BPA project's packages as NCBI BioSample and SRA submissions. a project is
+    a subclass which declares its package types, projection, filter rules and the specs
+    of its rows (see spec.py); the specs are compiled into row builders as the subclass
+    is defined.
+    """
+    # names this project's manifest and diagnostics
+    name = None
+    # the package types fetched. packages are indexed in this order, which orders
+    # packages with the same sample id
+    package_types = ()
+    # the package and resource fields used to build the submission; nothing else is fetched
+    projection = None
+    # the fields used to build BioSample rows, which must be common to each (sample_id, depth)
+    biosample_fields = ()
+    # filter rules, applied in order: a record is skipped for the first rule it fails
+    package_rules = ()
+    submit_rules = ()
+    biosample_rules = ()
+    resource_rules = (
+        # TODO hard coded filter on ncbi_file_uploaded
+        Rule('ncbi_file_uploaded', not_equal('ncbi_file_uploaded', 'True')),
+        Rule('read missing', truthy('read')),
+        # TODO hardcoded filter on read
+        Rule('read', one_of('read', ('R1', 'R2', 'I1', 'I2'))),
+    )
+
+    # the BioSample row built from the common fields of each (sample_id, depth)
+    biosample_spec = None
+    # the SRA row built from each package, common to all types, and the fields specific to
+    # each type. packages of types not listed are skipped.
+    sra_spec = None
+    sra_type_specs = {}
+
+    biosample_base = None
+    sra_base = None
+
+    def __init_subclass__(cls, **kwargs):
+        super(NCBIExporter, cls).__init_subclass__(**kwargs)
+        # the projection and biosample_fields are kept by hand alongside the specs: a field
+        # missing from them would never be fetched, or grouped, so fail as the class is defined
+        if cls.projection is not None:
+            missing = set(cls.biosample_fields).difference(cls.projection.fields)
+            if missing:
+                raise ValueError('{}: biosample_fields not in the projection: {}'.format(
+                    cls.__name__, ', '.join(sorted(missing))))
+        if cls.biosample_spec is not None:
+            missing = spec_fields(cls.biosample_spec).difference(cls.biosample_fields)
+            if missing:
+                raise ValueError('{}: fields of biosample_spec not in biosample_fields: {}'.format(
+                    cls.__name__, ', '.join(sorted(missing))))
+            cls.build_biosample_row = staticmethod(compile_builder(
+                BioSampleRow, cls.biosample_spec, name='build_{}_biosample_row'.format(cls.name)))
+        if cls.sra_spec is not None:
+            record_type = cls.projection.record_type if cls.projection is not None else None
+            cls.sra_builders = dict(
+                (typ, compile_builder(SRARow, dict(cls.sra_spec, **specific), record_type=record_type,
+                                      name='build_{}_sra_row'.format(typ.replace('-', '_'))))
+                for typ, specific in cls.sra_type_specs.items())
+
+    def __init__(self, ckan, args, diagnostics=None, store=None):
+        self._setup(ckan, args, diagnostics)
+        if store is None and args.store:
+            store = PackageStore(args.store)
+
+        def packages_of_type(typ):
+            # packages from the store are filtered by the same rules as those fetched
+            if store is not None:
+                store.sync(ckan, typ, projection=self.projection, workers=args.fetch_workers)
+                packages = store.packages((typ,))
+            else:
+                packages = ckan_packages_of_type(ckan, typ, workers=args.fetch_workers, projection=self.projection)
+            return self._records(self.filter_packages(typ, packages))
+
+        packages = run_concurrently(packages_of_type, self.package_types, 'Fetch')
+        self.prepare([package for typ in self.package_types for package in packages[typ]])
+        self.write_ncbi()
+
+    def _setup(self, ckan, args, diagnostics):
+        self.ckan = ckan
+        self.args = args
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+
+    @classmethod
+    def from_packages(cls, packages, args, ckan=None, diagnostics=None):
+        """
+        an exporter over already fetched and filtered package records, ready to write
+        """
+        self = cls.__new__(cls)
+        self._setup(ckan, args, diagnostics)
+        self.prepare(packages)
+        return self
+
+    @classmethod
+    def from_catalogue(cls, catalogue, args, ckan=None, diagnostics=None):
+        """
+        an exporter over `catalogue`, a dict of the packages of each of package_types as
+        ckan_packages_of_type() returns them, filtered and ready to write
+        """
+        self = cls.__new__(cls)
+        self._setup(ckan, args, diagnostics)
+        self.prepare([
+            package for typ in self.package_types
+            for package in self._records(self.filter_packages(typ, catalogue[typ]))])
+        return self
+
+    def filter_packages(self, typ, packages):
+        """
+        the packages of type `typ` which pass the package rules
+        """
+        pipeline = FilterPipeline(typ, self.package_rules)
+        with stage('filter') as measured:
+            packages, _ = pipeline.run(packages)
+            measured.count = len(packages)
+        self._report(pipeline)
+        return packages
+
+    def _records(self, packages):
+        with stage('records', count=len(packages)):
+            return [self.projection.record(t) for t in packages]
+
+    def prepare(self, packages):
+        """
+        index `packages`, and compile the filters applied as rows are built from them
+        """
+        self.packages = packages
+        with stage('index', count=len(packages)):
+            self.index = PackageIndex(self.packages)
+        self._id_depth_metadata = None
+        self.reset()
+
+    def reset(self):
+        """
+        drop the rows built by write_ncbi() or plan(), and compile fresh filters, so that
+        the rows can be built again
+        """
+        self.index.clear_sra_rows()
+        self.submit_filter = FilterPipeline('package', self.submit_rules)
+        self.biosample_filter = FilterPipeline('biosample', self.biosample_rules)
+        self.resource_filter = FilterPipeline('resource', self.resource_rules)
+        self.verify_filter = None
+        if self.args.verify_md5:
+            with stage('verify'):
+                self.verify_filter = FilterPipeline('verify', self._verification_rules())
+
+    def _verification_rules(self):
+        # check the md5 of each resource which would otherwise be submitted. these filters are
+        # run again, and tallied, as the rows are built
+        packages = FilterPipeline('package', self.submit_rules).filter(self.index.by_sample_id())
+        resources = FilterPipeline('resource', self.resource_rules).filter(
+            resource for package in packages for resource in package['resources'])
+        verifier = MD5Verifier(
+            authenticated_ckan_session(self.ckan), 'cache/md5-{}.jsonl'.format(self.name),
+            workers=self.args.verify_workers, bytes_per_second=self.args.verify_bandwidth * 1e6)
+        return verification_rules(verifier.verify(resources))
+
+    @classmethod
+    def _build_id_depth_metadata(cls, packages):
+        # group together by (sample_id, depth), then take the common values of the fields we use
+        return group_common(
+            packages, lambda package: (package['sample_id'], package.get('depth', '')), cls.biosample_fields)
+
+    def packages_to_submit(self, packages):
+        # packages must already be in sample id order, as PackageIndex keeps them
+        return self.submit_filter.filter(packages)
+
+    def resources_to_submit(self, resources):
+        return self.resource_filter.filter(resources)
+
+    def verified(self, obj, resources):
+        """
+        whether each of `resources`, those of `obj` to be submitted, passed verification
+        """
+        if self.verify_filter is None:
+            return True
+        row = {'id': obj.get('id'), 'sample_id': obj.get('sample_id'), 'resources': resources}
+        return any(self.verify_filter.filter((row,)))
+
+    @staticmethod
+    def resource_file_info(resources):
+        # TODO hard coded values: resource_obj['Format']?
+        return [['fastq', resource_obj['url'].rsplit('/', 1)[-1], resource_obj['md5']] for resource_obj in resources]
+
+    def ncbi_metagenome_objects(self):
+        build = self.build_biosample_row
+        if self._id_depth_metadata is None:
+            with stage('grouping') as measured:
+                self._id_depth_metadata = self._build_id_depth_metadata(self.index.by_sample_id())
+                measured.count = len(self._id_depth_metadata)
+        for obj in self.biosample_filter.filter(self._id_depth_metadata):
+            yield build(obj)
+
+    def ncbi_sra_objects(self):
+        builders = self.sra_builders
+        for obj in self.packages_to_submit(self.index.by_sample_id()):
+            resources = list(self.resources_to_submit(obj['resources']))
+            if not self.verified(obj, resources):
+                continue
+            file_info = self.resource_file_info(resources)
+            build = builders.get(obj['type'])
+            if build is None:
+                logger.error('Skipping package (type) sample_id: {0} id: {1} has-resources: {2}'.format(
+                    obj.get('sample_id'), obj.get('id'), 'resources' in obj))
+                continue
+            row_obj = build(obj)
+            # TODO do we need to yield if there is no file info???
+            if file_info:
+                yield row_obj, file_info
+
+    def _submission(self):
+        # the arguments common to planning and writing the submission files
+        state = None
+        if self.args.incremental:
+            state = SubmissionState(os.path.join(self.args.output_dir, 'submitted-{}.json'.format(self.name)))
+        return dict(
+            # the custom fields are fixed by the row types the specs build; SRA rows have none
+            biosample_custom_fields=BIOSAMPLE_CUSTOM_FIELDS,
+            biosample_base=self.biosample_base,
+            biosample_rows=self.ncbi_metagenome_objects(),
+            sra_custom_fields=(),
+            sra_base=self.sra_base,
+            sra_rows=self.ncbi_sra_objects(),
+            packing=self.args.packing,
+            index=self.index,
+            output_dir=self.args.output_dir,
+            state=state)
+
+    def write_ncbi(self):
+        """
+        write the submission files; returns their manifest
+        """
+        manifest = write_sra_biosample(
+            workers=self.args.write_workers,
+            manifest_filename='manifest-{}.json'.format(self.name),
+            sink=make_sink(self.args, 'submission-{}'.format(self.name)),
+            **self._submission())
+        for pipeline in (self.submit_filter, self.biosample_filter, self.resource_filter, self.verify_filter):
+            if pipeline is not None:
+                self._report(pipeline)
+        return manifest
+
+    def plan(self):
+        """
+        the files write_ncbi() would write, with the samples and number of rows in each.
+        nothing is written, and with --incremental nothing is recorded as submitted.
+        """
+        _, files = plan_submission(**self._submission())
+        return [
+            {'filename': os.path.basename(filename), 'rows': len(rows), 'samples': samples}
+            for _, _, filename, rows, samples in files or ()]
+
+    def _report(self, pipeline):
+        pipeline.report()
+        self.diagnostics.add(self.name, pipeline)
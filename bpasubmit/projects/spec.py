@@ -0,0 +1,176 @@
+"""
+declarative specs of the rows a project submits, and their compilation into row builders.
+
+a spec is a dict from each field of a row type (BioSampleRow, SRARow) to its value: a
+constant, a Field of the package, a Call of a function, or a Format of a string template;
+the arguments of Call and Format are themselves constants or values. compile_builder()
+turns a spec into a function which builds a row from a package in a single pass, setting
+each field of the row directly, with no intermediate dicts.
+"""
+from ..util import sample_id_slash
+
+REQUIRED = object()
+
+
+def _constant(value, namespace):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return repr(value)
+    name = '_c{}'.format(len(namespace))
+    namespace[name] = value
+    return name
+
+
+def _source(value, namespace, record_type):
+    if isinstance(value, Value):
+        return value.source(namespace, record_type)
+    return _constant(value, namespace)
+
+
+class Value(object):
+    def source(self, namespace, record_type):
+        """
+        a python expression for this value, of `package`. names it refers to are added to
+        `namespace`. if `record_type` is given, `package` is known to be one.
+        """
+        raise NotImplementedError()
+
+
+class Package(Value):
+    """
+    the package itself, to pass to a Call
+    """
+
+    def source(self, namespace, record_type):
+        return 'package'
+
+
+PACKAGE = Package()
+
+
+class Field(Value):
+    """
+    the field `name` of the package. without a `default`, the field must be present.
+    """
+
+    def __init__(self, name, default=REQUIRED):
+        self.name = name
+        self.default = default
+
+    def source(self, namespace, record_type):
+        if record_type is not None and self.name not in record_type.fields:
+            # the field would never be fetched: every row would fail, or silently take the default
+            raise ValueError('Field {!r} is not in the projection'.format(self.name))
+        if record_type is None or not self.name.isidentifier():
+            if self.default is REQUIRED:
+                return 'package[{!r}]'.format(self.name)
+            return 'package.get({!r}, {})'.format(self.name, _constant(self.default, namespace))
+        # read the record's slot directly, as Record.get and [] would
+        if self.default is REQUIRED:
+            return 'package.{}'.format(self.name)
+        return 'getattr(package, {!r}, {})'.format(self.name, _constant(self.default, namespace))
+
+
+class Call(Value):
+    """
+    the result of `func(*args)`
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def source(self, namespace, record_type):
+        return '{}({})'.format(
+            _constant(self.func, namespace), ', '.join(_source(t, namespace, record_type) for t in self.args))
+
+
+class Format(Value):
+    """
+    `template % args`
+    """
+
+    def __init__(self, template, *args):
+        self.template = template
+        self.args = args
+
+    def source(self, namespace, record_type):
+        return '{!r} % ({},)'.format(self.template, ', '.join(_source(t, namespace, record_type) for t in self.args))
+
+
+def spec_fields(spec):
+    """
+    the names of the package fields read by the Fields of `spec`. fields read by a
+    function called with the whole PACKAGE are not included.
+    """
+    names = set()
+
+    def walk(value):
+        if isinstance(value, Field):
+            names.add(value.name)
+        elif isinstance(value, (Call, Format)):
+            for t in value.args:
+                walk(t)
+
+    for value in spec.values():
+        walk(value)
+    return names
+
+
+def compile_builder(row_type, spec, record_type=None, name='build_row'):
+    """
+    compile `spec` into a function of a package which returns a `row_type`. fields of the
+    row which are not in the spec are left unset. if `record_type` is given, the function
+    reads fields straight from the slots of packages of that type.
+    """
+    unknown = set(spec) - set(row_type.fields)
+    if unknown:
+        raise ValueError('{} has no fields: {}'.format(row_type.__name__, ', '.join(sorted(unknown))))
+
+    def generate(record_type, generic=None):
+        namespace = {'_new': row_type.__new__, '_row_type': row_type}
+        lines = ['def {}(package):'.format(name)]
+        if generic is not None:
+            # anything other than a record_type is handed to the generic builder
+            namespace.update(_record_type=record_type, _generic=generic)
+            lines += ['    if type(package) is not _record_type:', '        return _generic(package)']
+        lines.append('    row = _new(_row_type)')
+        for field in row_type.fields:
+            if field in spec:
+                lines.append('    row.{} = {}'.format(field, _source(spec[field], namespace, record_type)))
+        lines.append('    return row')
+        exec('\n'.join(lines), namespace)
+        return namespace[name]
+
+    generic = generate(None)
+    if record_type is None:
+        return generic
+    return generate(record_type, generic)
+
+
+# helpers for the values of specs
+
+def represent_depth(depth):
+    # some are floating point values, but we need to integer-f
+    try:
+        return int(float(depth))
+    except ValueError:
+        # not cast-able to a float, just return as a string
+        # example: "10_20"
+        return depth
+
+
+def isolate(sample_id, depth):
+    if not sample_id or not depth:
+        return ''
+    return '%s_%s' % (sample_id_slash(sample_id), represent_depth(depth))
+
+
+def sra_sample_name(package):
+    # biosample_accession and sample_name cannot both be set
+    if package.get('ncbi_biosample_accession', ''):
+        return None
+    return sample_id_slash(package['sample_id'])
+
+
+def upper(value):
+    return value.upper()
@@ -0,0 +1,120 @@
+class Record(object):
+    """
+    a compact, read-mostly stand-in for a dict over a fixed set of fields, stored in
+    __slots__ rather than a per-object hash table. fields which are not set behave
+    as missing keys, so `get`, `in` and `[]` work as they would on the source dict.
+    """
+    __slots__ = ()
+    fields = ()
+    _field_set = frozenset()
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def from_dict(cls, d):
+        obj = cls.__new__(cls)
+        for k in cls.fields:
+            if k in d:
+                setattr(obj, k, d[k])
+        return obj
+
+    def get(self, key, default=None):
+        if key not in self._field_set:
+            return default
+        return getattr(self, key, default)
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._field_set and hasattr(self, key)
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.fields if hasattr(self, k)]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.items() == other.items()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(k, v) for k, v in self.items()))
+
+
+def record_type(name, fields, module=None):
+    """
+    return a new Record subclass named `name` over `fields`. pass `module=__name__`
+    and bind the result to `name` at module level for the type to be picklable.
+    """
+    fields = tuple(fields)
+    namespace = {
+        '__slots__': fields,
+        'fields': fields,
+        '_field_set': frozenset(fields),
+    }
+    if module is not None:
+        namespace['__module__'] = module
+    return type(name, (Record,), namespace)
+
+
+class PackageRecord(Record):
+    """
+    base for package record types: like a Record, but its embedded resources are
+    themselves held as records, and the source package may optionally be retained
+    """
+    __slots__ = ('_raw',)
+    resource_type = None
+
+    @classmethod
+    def from_dict(cls, d, keep_raw=False):
+        obj = super(PackageRecord, cls).from_dict(d)
+        if 'resources' in d and cls.resource_type is not None:
+            obj.resources = tuple(cls.resource_type.from_dict(t) for t in d['resources'])
+        if keep_raw:
+            obj._raw = d
+        return obj
+
+    @property
+    def raw(self):
+        """
+        the package as fetched, if kept; otherwise a dict rebuilt from the record
+        """
+        try:
+            return self._raw
+        except AttributeError:
+            d = self.to_dict()
+            if 'resources' in d:
+                d['resources'] = [t.to_dict() for t in d['resources']]
+            return d
+
+
+def package_record_type(name, fields, resource_fields):
+    """
+    return a PackageRecord subclass over `fields`, whose resources are records over `resource_fields`
+    """
+    fields = tuple(fields)
+    return type(name, (PackageRecord,), {
+        '__slots__': fields,
+        'fields': fields,
+        '_field_set': frozenset(fields),
+        'resource_type': record_type(name + 'Resource', resource_fields),
+    })
@@ -0,0 +1,263 @@
+"""
+a long running service around the exporters, for curators who want fresh submission
+files without a cold run each time. the packages of each type are loaded once, warm
+from the cache kept by ckan_packages_of_type(), and then kept up to date by polling
+CKAN for changes in the background. each exporter's filtered packages, index and
+groupings are built once per change to its packages, rather than once per export.
+
+a small HTTP API, bound to localhost unless asked otherwise, serves:
+
+  GET  /status                    the packages held of each type, and when each was synced
+  GET  /plan[?exporter=NAME]      the files an export would write, and the samples in each
+  POST /export[?exporter=NAME]    write the submission files; returns their manifests, and
+                                  what was skipped
+  POST /refresh                   poll CKAN now, rather than waiting for the next poll
+
+exports are run one at a time, each as the command line would run it.
+"""
+import datetime
+import json
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .diagnostics import Diagnostics
+from .profiling import profiler
+from .projects import exporter_args
+from .util import (
+    make_logger, ckan_packages_of_type, high_water_mark, run_concurrently, sync_packages, write_package_cache)
+
+
+logger = make_logger(__name__)
+
+POLL_INTERVAL = 300
+
+
+class Service(object):
+    """
+    holds the packages of each type fetched by `exporters`, a dict of exporter classes by
+    name, and polls CKAN for changes to them every `poll_interval` seconds. changes are
+    merged in by id, and written through to the cache.
+    """
+
+    def __init__(self, ckan, args, exporters, poll_interval=POLL_INTERVAL):
+        self.ckan = ckan
+        self.args = args
+        self.exporters = exporters
+        self.poll_interval = poll_interval
+        # each type is fetched with the projection of the exporter which uses it
+        self.projections = {}
+        for name in sorted(exporters):
+            for typ in exporters[name].package_types:
+                if self.projections.setdefault(typ, exporters[name].projection) != exporters[name].projection:
+                    raise ValueError('Package type {} is used with differing projections'.format(typ))
+        # the packages of each type, sorted by id, and a count of the changes to them
+        self.packages = {}
+        self.versions = dict((typ, 0) for typ in self.projections)
+        self.synced = {}
+        # (key, exporter, package filter diagnostics) by name, where key identifies the
+        # packages it was prepared over
+        self._prepared = {}
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.server = None
+
+    def _types(self):
+        return sorted(self.projections)
+
+    def load(self):
+        """
+        load the packages of each type, from the cache if there is one, synced with CKAN
+        """
+        def load_type(typ):
+            return ckan_packages_of_type(
+                self.ckan, typ, workers=self.args.fetch_workers, projection=self.projections[typ])
+
+        with self._poll_lock:
+            loaded = run_concurrently(load_type, self._types(), 'Load')
+            synced = _now()
+            with self._lock:
+                for typ, data in loaded.items():
+                    self.packages[typ] = data
+                    self.versions[typ] += 1
+                    self.synced[typ] = synced
+
+    def _poll_type(self, typ):
+        with self._lock:
+            cached = self.packages[typ]
+        projection = self.projections[typ]
+        packages, changed, deleted = sync_packages(
+            self.ckan, typ, cached, workers=self.args.fetch_workers, projection=projection)
+        if changed or deleted:
+            write_package_cache(typ, packages, projection)
+        with self._lock:
+            if changed or deleted:
+                self.packages[typ] = packages
+                self.versions[typ] += 1
+            self.synced[typ] = _now()
+        return packages
+
+    def poll(self):
+        """
+        fetch the changes to each type from CKAN, and merge them in
+        """
+        with self._poll_lock:
+            run_concurrently(self._poll_type, self._types(), 'Poll')
+
+    def _poll_forever(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                # keep serving the packages we have, and try again at the next poll
+                logger.error('Poll failed: {!r}'.format(e))
+
+    def status(self):
+        with self._lock:
+            return {
+                'exporters': sorted(self.exporters),
+                'poll_interval': self.poll_interval,
+                'types': dict((typ, {
+                    'packages': len(self.packages.get(typ, ())),
+                    'version': self.versions[typ],
+                    'synced': self.synced.get(typ),
+                    'high_water': high_water_mark(self.packages.get(typ, ())),
+                }) for typ in self._types()),
+            }
+
+    def exporter(self, name):
+        """
+        the exporter `name`, prepared over the current packages. it is only rebuilt when
+        its packages have changed, or the day has (which moves the embargo cutoff).
+        must be called holding the export lock.
+        """
+        cls = self.exporters[name]
+        with self._lock:
+            key = (datetime.date.today(), tuple(self.versions[typ] for typ in cls.package_types))
+            catalogue = dict((typ, self.packages[typ]) for typ in cls.package_types)
+        prepared = self._prepared.get(name)
+        if prepared is None or prepared[0] != key:
+            start = time.time()
+            exporter = cls.from_catalogue(catalogue, exporter_args(self.args, name, self.exporters), ckan=self.ckan)
+            prepared = self._prepared[name] = (key, exporter, list(exporter.diagnostics.stages))
+            logger.info('Prepared exporter ({}) packages: {} in {:.2f}s'.format(
+                name, len(exporter.packages), time.time() - start))
+        key, exporter, filtered = prepared
+        exporter.reset()
+        # each export reports what it skipped, starting from the packages filtered out
+        # as the exporter was prepared, rather than adding to the tallies of earlier exports
+        exporter.diagnostics = Diagnostics()
+        exporter.diagnostics.stages.extend(filtered)
+        return exporter
+
+    def _names(self, name=None):
+        return sorted(self.exporters) if name is None else [name]
+
+    def plan(self, name=None):
+        """
+        the files an export of `name`, or of every exporter, would write, by exporter
+        """
+        with self._export_lock:
+            return dict((t, self.exporter(t).plan()) for t in self._names(name))
+
+    def export(self, name=None):
+        """
+        write the submission files of `name`, or of every exporter; returns the
+        manifest of each, and what was skipped, by exporter, and with --profile the
+        stages of this export.
+        """
+        with self._export_lock:
+            # measure this export alone, not every export since the service started
+            profiler.reset()
+            result = {}
+            for t in self._names(name):
+                start = time.time()
+                exporter = self.exporter(t)
+                manifest = exporter.write_ncbi()
+                result[t] = {
+                    'output_dir': exporter.args.output_dir,
+                    'manifest': manifest,
+                    'skipped': exporter.diagnostics.stages,
+                    'seconds': round(time.time() - start, 3),
+                }
+                logger.info('Export complete ({}) files: {} in {:.2f}s'.format(t, len(manifest), time.time() - start))
+            return {'exporters': result, 'profile': profiler.summary() if profiler.enabled else None}
+
+    def serve(self, host='127.0.0.1', port=8000):
+        """
+        load the packages, then poll CKAN in the background and serve the API until
+        interrupted
+        """
+        self.load()
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        poller = threading.Thread(target=self._poll_forever, name='poll', daemon=True)
+        poller.start()
+        logger.info('Serving on http://{}:{}/ polling every {}s'.format(
+            host, self.server.server_address[1], self.poll_interval))
+        # stop as cleanly on SIGTERM, as a service manager sends, as on an interrupt
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.set()
+            self.server.server_close()
+            logger.info('Service stopped')
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat()
+
+
+def _handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, fmt, *args):
+            logger.info('%s %s', self.address_string(), fmt % args)
+
+        def _json(self, status, obj):
+            body = json.dumps(obj, indent=2, sort_keys=True).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, routes):
+            url = urlparse(self.path)
+            route = routes.get(url.path.rstrip('/'))
+            if route is None:
+                return self._json(404, {'error': 'not found: {}'.format(url.path)})
+            name = parse_qs(url.query).get('exporter', [None])[-1]
+            if name is not None and name not in service.exporters:
+                return self._json(404, {'error': 'unknown exporter: {}'.format(name)})
+            try:
+                result = route(name)
+            except Exception as e:
+                logger.error('Request failed ({}): {!r}'.format(self.path, e))
+                return self._json(500, {'error': repr(e)})
+            return self._json(200, result)
+
+        def do_GET(self):
+            self._handle({
+                '/status': lambda name: service.status(),
+                '/plan': service.plan,
+            })
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            self._handle({
+                '/export': service.export,
+                '/refresh': lambda name: service.poll() or service.status(),
+            })
+
+    return Handler
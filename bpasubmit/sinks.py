@@ -0,0 +1,249 @@
+"""
+output sinks for submission files. a sink renders each file through a large write buffer,
+optionally compressing it as it is written, and checksums the data as it passes through:
+both the content (the md5 NCBI is given) and, if compressed, the bytes stored.
+
+FileSink writes each file into the output directory. ArchiveSink packages every file of
+a run into one tar archive, compressed as a single stream, with an md5 of the archive
+written alongside it.
+
+gzip uses the standard library; zstd needs the optional zstandard package.
+"""
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+import time
+
+from .jsonio import replace_atomic
+from .util import make_logger
+
+
+logger = make_logger(__name__)
+
+# text is encoded, checksummed and written on in blocks of this size
+BUFFER_SIZE = 1 << 20
+COMPRESSIONS = ('gzip', 'zstd')
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('zstd compression requires the zstandard package: pip install zstandard')
+    return zstandard
+
+
+class _HashingWriter(object):
+    """
+    a binary file-like object which writes through to `fd`, keeping a running count and
+    checksum of the bytes written
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.md5 = hashlib.md5()
+        self.bytes = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.bytes += len(data)
+        self.fd.write(data)
+        return len(data)
+
+    def flush(self):
+        self.fd.flush()
+
+
+class _TextWriter(_HashingWriter):
+    """
+    a text file-like object which collects what is written, and encodes, checksums and
+    writes it through to the binary `fd` a block at a time
+    """
+
+    def __init__(self, fd, encoding='utf-8', buffer_size=BUFFER_SIZE):
+        super(_TextWriter, self).__init__(fd)
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self._pending = []
+        self._pending_size = 0
+
+    def write(self, s):
+        self._pending.append(s)
+        self._pending_size += len(s)
+        if self._pending_size >= self.buffer_size:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self._pending:
+            super(_TextWriter, self).write(''.join(self._pending).encode(self.encoding))
+            self._pending = []
+            self._pending_size = 0
+
+
+def _compressor(fd, compression, level=None):
+    """
+    a binary file-like object which compresses what is written to it into `fd`
+    """
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        # mtime=0 so that the same content always compresses to the same bytes
+        return gzip.GzipFile(fileobj=fd, mode='wb', compresslevel=6 if level is None else level, mtime=0)
+    if compression == 'zstd':
+        zstandard = _zstandard()
+        return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(fd, closefd=False)
+    raise ValueError('unknown compression: {}'.format(compression))
+
+
+def _render(writer, custom_fields, fd, rows, compression=None, level=None, buffer_size=BUFFER_SIZE):
+    """
+    render `rows` with `writer` into the binary `fd`, compressed if asked. returns the
+    manifest entry for the content, less its filename.
+    """
+    stored = _HashingWriter(fd)
+    compressor = _compressor(stored, compression, level)
+    out = _TextWriter(compressor if compressor is not None else stored, buffer_size=buffer_size)
+    nrows = writer.write(custom_fields, out, rows)
+    out.flush()
+    entry = {
+        'rows': nrows,
+        'bytes': out.bytes,
+        'md5': out.md5.hexdigest(),
+    }
+    if compressor is not None:
+        compressor.close()
+        entry['compressed_bytes'] = stored.bytes
+        entry['compressed_md5'] = stored.md5.hexdigest()
+    return entry
+
+
+class _Directory(object):
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def add(self, entry):
+        return entry
+
+    def add_file(self, name, data):
+        replace_atomic(os.path.join(self.output_dir, name), lambda fd: fd.write(data), buffering=BUFFER_SIZE)
+
+
+class FileSink(object):
+    """
+    writes each file into the output directory, compressed with `compression` (None, 'gzip'
+    or 'zstd') if given. files are written alongside, and moved into place once complete.
+    """
+
+    def __init__(self, compression=None, level=None, buffer_size=BUFFER_SIZE):
+        if compression == 'zstd':
+            _zstandard()
+        self.compression = compression
+        self.level = level
+        self.buffer_size = buffer_size
+
+    def write(self, writer, custom_fields, filename, rows):
+        """
+        render `rows` to `filename` with `writer`; may be called in a worker process.
+        returns the manifest entry for the file.
+        """
+        filename += EXTENSIONS[self.compression]
+        entry = replace_atomic(filename, lambda fd: _render(
+            writer, custom_fields, fd, rows, self.compression, self.level, self.buffer_size), buffering=self.buffer_size)
+        entry['filename'] = os.path.basename(filename)
+        return entry
+
+    def open(self, output_dir):
+        """
+        a context in which the results of write() are collected with add(), and other files
+        such as the manifest are added with add_file()
+        """
+        return _Directory(output_dir)
+
+
+class _Archive(object):
+    def __init__(self, sink, filename):
+        self.sink = sink
+        self.filename = filename
+        self.mtime = int(time.time())
+
+    def __enter__(self):
+        self._tmp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        self._fd = open(self._tmp_filename, 'wb', buffering=self.sink.buffer_size)
+        self._stored = _HashingWriter(self._fd)
+        self._compressor = _compressor(self._stored, self.sink.compression, self.sink.level)
+        self._tar = tarfile.open(
+            fileobj=self._compressor if self._compressor is not None else self._stored, mode='w|',
+            bufsize=self.sink.buffer_size)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._tar.close()
+            if self._compressor is not None:
+                self._compressor.close()
+            self._fd.close()
+            if exc_type is None:
+                os.replace(self._tmp_filename, self.filename)
+        finally:
+            if os.path.exists(self._tmp_filename):
+                os.unlink(self._tmp_filename)
+        if exc_type is None:
+            md5 = self._stored.md5.hexdigest()
+            with open(self.filename + '.md5', 'w') as fd:
+                fd.write('{}  {}\n'.format(md5, os.path.basename(self.filename)))
+            logger.info('Wrote archive {} bytes: {} md5: {}'.format(
+                os.path.basename(self.filename), self._stored.bytes, md5))
+
+    def add(self, result):
+        entry, data = result
+        self.add_file(entry['filename'], data)
+        return entry
+
+    def add_file(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self._tar.addfile(info, io.BytesIO(data))
+
+
+class ArchiveSink(FileSink):
+    """
+    packages every file of a run into the tar archive `name`.tar in the output directory,
+    compressed as one stream with `compression` if given (`name`.tar.gz, `name`.tar.zst).
+    files are rendered in memory, and appended to the archive as they are ready; the md5
+    of the archive is computed as it is written, and saved alongside it in md5sum format.
+    """
+
+    def __init__(self, name, compression=None, level=None, buffer_size=BUFFER_SIZE):
+        super(ArchiveSink, self).__init__(compression, level, buffer_size)
+        self.name = name
+
+    def write(self, writer, custom_fields, filename, rows):
+        data = io.BytesIO()
+        entry = _render(writer, custom_fields, data, rows, buffer_size=self.buffer_size)
+        entry['filename'] = os.path.basename(filename)
+        return entry, data.getvalue()
+
+    def open(self, output_dir):
+        return _Archive(self, os.path.join(output_dir, '{}.tar{}'.format(self.name, EXTENSIONS[self.compression])))
+
+
+def make_sink(args, name):
+    """
+    the sink chosen by the command line `args`; `name` names the archive, if one is made
+    """
+    buffer_size = int(args.write_buffer * (1 << 20))
+    if args.archive:
+        return ArchiveSink(name, compression=args.compress, buffer_size=buffer_size)
+    return FileSink(compression=args.compress, buffer_size=buffer_size)
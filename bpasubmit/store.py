@@ -0,0 +1,144 @@
+import json
+import sqlite3
+import threading
+
+from .profiling import stage
+from .util import make_logger, sample_id_short, ckan_package_pages, ckan_package_changes, Projection, CKAN_FETCH_WORKERS
+
+
+logger = make_logger(__name__)
+
+
+class PackageStore(object):
+    """
+    an indexed local SQLite mirror of CKAN packages. the fields they are synced and ordered
+    by are lifted out into columns; the package itself is kept as JSON.
+    """
+    # depth, archive_ingestion_date and ncbi_biosample_accession are no longer read, but are
+    # kept so that existing stores can still be written to. the indexes, and resource table,
+    # which nothing queries are dropped from them.
+    schema = """
+CREATE TABLE IF NOT EXISTS package (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    sample_id TEXT,
+    sample_id_short INTEGER,
+    depth TEXT,
+    archive_ingestion_date TEXT,
+    ncbi_biosample_accession TEXT,
+    metadata_modified TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS package_type ON package (type, sample_id_short, id);
+DROP INDEX IF EXISTS package_sample_id_depth;
+DROP INDEX IF EXISTS package_archive_ingestion_date;
+DROP INDEX IF EXISTS package_ncbi_biosample_accession;
+DROP TABLE IF EXISTS resource;
+CREATE TABLE IF NOT EXISTS sync_state (
+    type TEXT PRIMARY KEY,
+    projection TEXT
+);
+"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        # the connection is shared between fetch threads, so serialise access to it
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript(self.schema)
+
+    def close(self):
+        self._db.close()
+
+    @classmethod
+    def _package_row(cls, package):
+        short = sample_id_short(package.get('sample_id'))
+        try:
+            short = int(short)
+        except (TypeError, ValueError):
+            short = None
+        return (
+            package['id'],
+            package['type'],
+            package.get('sample_id'),
+            short,
+            package.get('depth'),
+            package.get('archive_ingestion_date'),
+            package.get('ncbi_biosample_accession'),
+            package.get('metadata_modified'),
+            json.dumps(package, sort_keys=True))
+
+    def _delete(self, package_ids):
+        self._db.executemany('DELETE FROM package WHERE id = ?', ((t,) for t in package_ids))
+
+    def upsert(self, packages):
+        packages = list(packages)
+        with self._lock, self._db:
+            self._delete(t['id'] for t in packages)
+            self._db.executemany('INSERT INTO package VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (self._package_row(t) for t in packages))
+
+    def ids(self, typ):
+        with self._lock:
+            return set(t for (t,) in self._db.execute('SELECT id FROM package WHERE type = ?', (typ,)))
+
+    def high_water(self, typ):
+        with self._lock:
+            return self._db.execute('SELECT MAX(metadata_modified) FROM package WHERE type = ?', (typ,)).fetchone()[0]
+
+    def _projection(self, typ):
+        with self._lock:
+            row = self._db.execute('SELECT projection FROM sync_state WHERE type = ?', (typ,)).fetchone()
+        return Projection.from_key(json.loads(row[0])) if row is not None else None
+
+    def _set_projection(self, typ, projection):
+        key = json.dumps(projection.key() if projection is not None else None)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', (typ, key))
+
+    def sync(self, ckan, typ, projection=None, workers=CKAN_FETCH_WORKERS):
+        """
+        bring the mirror of packages of type `typ` up to date with CKAN, storing only
+        the fields in `projection` if given, fetching with `workers` concurrent requests
+        """
+        with stage('fetch'):
+            self._sync(ckan, typ, projection, workers)
+
+    def _sync(self, ckan, typ, projection, workers):
+        high_water = self.high_water(typ)
+        if high_water is not None and self._projection(typ) != projection:
+            # the stored packages may be missing fields we now need
+            stale = self.ids(typ)
+            with self._lock, self._db:
+                self._delete(stale)
+            high_water = None
+
+        if high_water is None:
+            self._set_projection(typ, projection)
+            for_upsert = []
+            for package in ckan_package_pages(ckan, typ, workers=workers, projection=projection):
+                for_upsert.append(package)
+                if len(for_upsert) == 1000:
+                    self.upsert(for_upsert)
+                    for_upsert = []
+            self.upsert(for_upsert)
+            logger.info('Stored packages (type: {}) count: {}'.format(typ, len(self.ids(typ))))
+            return
+
+        known_ids = self.ids(typ)
+        live_ids, changed = ckan_package_changes(ckan, typ, high_water, known_ids, workers=workers, projection=projection)
+        deleted = known_ids - live_ids
+        with self._lock, self._db:
+            self._delete(deleted)
+        self.upsert(changed)
+        logger.info('Synced stored packages (type: {}) changed: {} deleted: {}'.format(typ, len(changed), len(deleted)))
+
+    def packages(self, types):
+        """
+        return the stored packages of `types`, ordered by their numeric sample id
+        """
+        query = 'SELECT data FROM package WHERE type IN ({}) ORDER BY sample_id_short, id'.format(
+            ', '.join('?' for _ in types))
+        with stage('store_query') as measured, self._lock:
+            packages = [json.loads(t) for (t,) in self._db.execute(query, list(types))]
+            measured.count = len(packages)
+        return packages
@@ -0,0 +1,136 @@
+import datetime
+import json
+import random
+
+
+PROJECT_TYPES = {
+    'base': ('base-metagenomics', 'base-genomics-amplicon'),
+    'mm': ('mm-genomics-amplicon', 'mm-metagenomics', 'mm-metatranscriptome'),
+}
+
+
+def _resource(rnd, package_id, sample_num, n, modified):
+    read = rnd.choice(('R1', 'R2', 'R1', 'R2', 'I1', 'I2', '', 'QC'))
+    filename = '{}_{}_{}.fastq.gz'.format(sample_num, n, read or 'unknown')
+    return {
+        'cache_last_updated': None,
+        'cache_url': None,
+        'created': modified,
+        'datastore_active': False,
+        'description': 'Sequence file {} of sample {}'.format(n, sample_num),
+        'format': 'FASTQ',
+        'hash': '',
+        'id': '{}-{}'.format(package_id, n),
+        'last_modified': modified,
+        'md5': '%032x' % rnd.getrandbits(128),
+        'mimetype': 'application/gzip',
+        'mimetype_inner': None,
+        'name': filename,
+        'ncbi_file_uploaded': 'True' if rnd.random() < 0.2 else 'False',
+        'package_id': package_id,
+        'position': n,
+        'read': read,
+        'resource_type': None,
+        'size': rnd.randint(10 ** 6, 10 ** 10),
+        'state': 'active',
+        'url': 'https://example.org/dataset/{}/resource/{}/download/{}'.format(package_id, n, filename),
+        'url_type': 'upload',
+    }
+
+
+def synthetic_package(rnd, project, n, sample_num, depth, today):
+    """
+    a single CKAN package dict, shaped like those of `project` ('base' or 'mm'), including
+    the many fields CKAN returns which the exporters never use
+    """
+    typ = rnd.choice(PROJECT_TYPES[project])
+    package_id = '{}-{:08d}'.format(project, n)
+    ingested = today - datetime.timedelta(days=rnd.randint(0, 1500))
+    modified = '{}T{:02d}:{:02d}:{:02d}.{:06d}'.format(
+        ingested.isoformat(), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59), n % 1000000)
+    package = {
+        'amplicon': rnd.choice(('16S', '18S', 'ITS', 'A16S')),
+        'archive_ingestion_date': ingested.isoformat(),
+        'author': 'Bioplatforms Australia',
+        'author_email': 'help@bioplatforms.com',
+        'creator_user_id': '%032x' % rnd.getrandbits(128),
+        'data_type': rnd.choice(('Illumina HiSeq', 'Illumina MiSeq')),
+        'depth': depth,
+        'flow_id': 'A{}'.format(rnd.randint(10000, 99999)),
+        'geo_loc_name': rnd.choice(('Australia', 'Australia: New South Wales', 'Australia: Western Australia')),
+        'groups': [],
+        'id': package_id,
+        'isopen': False,
+        'license_id': 'other-closed',
+        'license_title': 'Other (Not Open)',
+        'metadata_created': modified,
+        'metadata_modified': modified,
+        'mm_amplicon_linkage': 'L{}'.format(rnd.randint(1, 9)),
+        'name': package_id,
+        'ncbi_biosample_accession': 'SAMN{:08d}'.format(sample_num) if rnd.random() < 0.1 else '',
+        'notes': 'Sample {} at depth {}. '.format(sample_num, depth) * 4,
+        'num_resources': 0,
+        'num_tags': 2,
+        'organization': {
+            'id': '%032x' % rnd.getrandbits(128),
+            'name': 'bpa-{}'.format(project),
+            'title': project.upper(),
+            'type': 'organization',
+            'is_organization': True,
+            'state': 'active',
+        },
+        'owner_org': 'bpa-{}'.format(project),
+        'private': True,
+        'read_length': str(rnd.choice((150, 250, 300))),
+        'relationships_as_object': [],
+        'relationships_as_subject': [],
+        'sample_id': '102.100.100/{}'.format(sample_num),
+        'sample_site_location_description': 'Site {}'.format(sample_num % 97),
+        'sample_type': rnd.choice(('Coastal water', 'Pelagic', 'Sediment', 'Sponge')),
+        'sequencer': rnd.choice(('HiSeq2500', 'Illumina HiSeq 2500', 'HiSeq 2500', 'MiSeq', '')),
+        'spatial': json.dumps({
+            'type': 'Point',
+            'coordinates': [round(rnd.uniform(110, 155), 6), round(rnd.uniform(-45, -10), 6)]}),
+        'state': 'active',
+        'tags': [{'name': project, 'display_name': project}, {'name': typ, 'display_name': typ}],
+        'ticket': 'BRLOPS-{}'.format(rnd.randint(1, 2000)),
+        'title': '{} {} {}'.format(project.upper(), typ, sample_num),
+        'type': typ,
+        'utc_date_sampled': '20{:02d}-{:02d}-{:02d}'.format(rnd.randint(12, 18), rnd.randint(1, 12), rnd.randint(1, 28)),
+        'version': None,
+    }
+    package['resources'] = [_resource(rnd, package_id, sample_num, i, modified) for i in range(rnd.randint(2, 4))]
+    package['num_resources'] = len(package['resources'])
+    return package
+
+
+def synthetic_packages(n, project='base', seed=0, today=None, edge_cases=0.05):
+    """
+    yield `n` synthetic CKAN packages shaped like those of `project` ('base' or 'mm').
+    packages share sample ids across several depths and types, as real ones do, and a
+    fraction `edge_cases` of them are damaged: missing mandatory or filtered-on fields,
+    or ingested too recently to be out of embargo.
+    """
+    rnd = random.Random(seed)
+    if today is None:
+        today = datetime.date.today()
+    sample_num = 8000
+    i = 0
+    while i < n:
+        sample_num += 1
+        # several depths per sample, with one or more packages at each
+        for depth in rnd.sample(('0', '5', '10', '10.0', '20', '0_10', '10_20'), rnd.randint(1, 3)):
+            for _ in range(rnd.randint(1, 3)):
+                if i == n:
+                    return
+                package = synthetic_package(rnd, project, i, sample_num, depth, today)
+                if rnd.random() < edge_cases:
+                    damage = rnd.choice(('spatial', 'sample_type', 'utc_date_sampled', 'archive_ingestion_date', 'embargo'))
+                    if damage == 'embargo':
+                        package['archive_ingestion_date'] = (today - datetime.timedelta(days=rnd.randint(0, 80))).isoformat()
+                    elif rnd.random() < 0.5:
+                        del package[damage]
+                    else:
+                        package[damage] = ''
+                yield package
+                i += 1
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+from .jsonio import replace_atomic
+
+
+class TransportStats(object):
+    """
+    thread-safe tally of the requests made through a session: how many, how long they
+    took to respond, and how many (possibly compressed) bytes came over the wire
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.bytes = 0
+
+    def record(self, latency, nbytes, error=False):
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.bytes += nbytes
+
+    def add_bytes(self, nbytes):
+        # for streamed responses, whose body is read after send() has returned
+        with self._lock:
+            self.bytes += nbytes
+
+    def summary(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'latency_total': round(self.latency, 3),
+                'latency_mean': round(self.latency / self.requests, 3) if self.requests else 0.0,
+                'latency_max': round(self.max_latency, 3),
+            }
+
+
+class Recorder(object):
+    """
+    captures CKAN responses into `directory`, one JSON file per request, or with `replay`
+    answers requests from those files without touching the network. requests are matched
+    on method, url and body; streamed downloads are neither recorded nor replayed.
+    """
+
+    def __init__(self, directory, replay=False):
+        self.directory = directory
+        self.replay = replay
+        if not replay and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _filename(self, request):
+        key = hashlib.md5('{} {}'.format(request.method, request.url).encode('utf8'))
+        # logins are matched on url alone, so credentials never reach the key
+        if request.body and not request.url.endswith('/login_generic'):
+            key.update(request.body if isinstance(request.body, bytes) else request.body.encode('utf8'))
+        return os.path.join(self.directory, key.hexdigest() + '.json')
+
+    def load(self, request):
+        filename = self._filename(request)
+        if not os.path.exists(filename):
+            raise requests.ConnectionError('no recorded response for {} {}'.format(request.method, request.url), request=request)
+        with open(filename) as fd:
+            entry = json.load(fd)
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['body'].encode('utf8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def save(self, request, response):
+        filename = self._filename(request)
+        entry = {
+            'method': request.method,
+            'url': request.url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {'Content-Type': response.headers.get('Content-Type', '')},
+            'body': response.content.decode('utf8'),
+        }
+        replace_atomic(filename, lambda fd: json.dump(entry, fd), mode='w')
+
+
+class CKANSession(requests.Session):
+    """
+    a requests session with a default timeout, which records the latency and size
+    of every response in `stats`. given a `recorder`, responses are captured by it, or
+    replayed from it.
+    """
+
+    def __init__(self, timeout, stats, recorder=None, retries=0, backoff=0):
+        super(CKANSession, self).__init__()
+        self.timeout = timeout
+        self.stats = stats
+        self.recorder = recorder
+        # how requests whose response fails as it is read, which urllib3 won't retry, should be
+        self.retries = retries
+        self.backoff = backoff
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        recorder = None if kwargs.get('stream') else self.recorder
+        if recorder is not None and recorder.replay:
+            response = recorder.load(request)
+            self.stats.record(0.0, len(response.content))
+            return response
+        start = time.monotonic()
+        try:
+            response = super(CKANSession, self).send(request, **kwargs)
+        except requests.RequestException:
+            self.stats.record(time.monotonic() - start, 0, error=True)
+            raise
+        nbytes = 0 if kwargs.get('stream') else response.raw.tell()
+        self.stats.record(time.monotonic() - start, nbytes, error=response.status_code >= 400)
+        if recorder is not None and response.status_code < 400:
+            recorder.save(request, response)
+        return response
+
+
+def _retry(**kwargs):
+    # package_search is made as a POST, but is safe to repeat, so every method is retried.
+    # urllib3 1.26 renamed method_whitelist to allowed_methods; the pinned requests needs
+    # an older urllib3
+    try:
+        return Retry(allowed_methods=None, **kwargs)
+    except TypeError:
+        return Retry(method_whitelist=None, **kwargs)
+
+
+def make_session(pool_size=10, retries=5, backoff=0.5, timeout=(10, 300), record=None, replay=None):
+    """
+    return a session with a connection pool of `pool_size` keep-alive connections per host,
+    compressed transfer, and `retries` retries with exponential backoff on 5xx responses,
+    connection failures and resets. a single session should be shared by every CKAN call in a run.
+
+    responses are captured into the directory `record`, or answered from the directory `replay`.
+    """
+    retry = _retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 503, 504),
+        # hand the final error response back, so ckanapi can report it
+        raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    recorder = None
+    if record is not None:
+        recorder = Recorder(record)
+    elif replay is not None:
+        recorder = Recorder(replay, replay=True)
+    session = CKANSession(timeout, TransportStats(), recorder=recorder, retries=retries, backoff=backoff)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
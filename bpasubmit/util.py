@@ -1,29 +1,64 @@
 import logging
+import io
+import itertools
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-import ckanapi
-import requests
-from dateutil.relativedelta import relativedelta
 import datetime
 
+# ckanapi, requests (through .transport) and dateutil are imported where they are used,
+# so the CLI can start, and answer --help and --version, without loading them
+from .records import package_record_type
+from .profiling import stage
+from . import jsonio
+
+
+LOGGER_ROOT = 'bpasubmit'
+
 
 def make_logger(name):
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    handler = logging.StreamHandler()
-    fmt = logging.Formatter(
-        "%(asctime)s [%(levelname)-7s] [%(threadName)s]  %(message)s")
-    handler.setFormatter(fmt)
-    logger.addHandler(handler)
-    return logger
+    """
+    loggers propagate to a single handler on the package logger, which logs at INFO
+    unless set_verbose() is called
+    """
+    root = logging.getLogger(LOGGER_ROOT)
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        fmt = logging.Formatter(
+            "%(asctime)s [%(levelname)-7s] [%(threadName)s]  %(message)s")
+        handler.setFormatter(fmt)
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+    return logging.getLogger(name)
+
+
+def set_verbose(verbose=True):
+    """
+    log a line for each skipped or renamed record
+    """
+    logging.getLogger(LOGGER_ROOT).setLevel(logging.DEBUG if verbose else logging.INFO)
 
 
 logger = make_logger(__name__)
 
 
-def make_ckan_api(args):
-    ckan = ckanapi.RemoteCKAN(args.ckan_url, apikey=args.api_key)
+# the most types any exporter fetches at once
+CKAN_CONCURRENT_TYPES = 3
+
+
+def make_ckan_api(args, concurrent_types=CKAN_CONCURRENT_TYPES, downloads=0):
+    import ckanapi
+    from .transport import make_session
+
+    # one pooled session is shared by every CKAN call, sized so each concurrent page fetch, and
+    # resource download, has a connection
+    session = make_session(
+        pool_size=args.fetch_workers * concurrent_types + downloads, retries=args.retries, timeout=(10, args.timeout),
+        record=args.record, replay=args.replay)
+    ckan = ckanapi.RemoteCKAN(args.ckan_url, apikey=args.api_key, session=session)
     return ckan
 
 
@@ -35,7 +70,8 @@ CKAN_AUTH = {
 
 # http://stackoverflow.com/questions/38271351/download-resources-from-private-ckan-datasets
 def authenticated_ckan_session(ckan):
-    s = requests.Session()
+    # log in on the shared, pooled session rather than opening a new one
+    s = ckan.session
     data = dict((k, os.environ.get(v)) for k, v in CKAN_AUTH.items())
     if any(t is None for t in data.values()):
         raise Exception('please set %s' % (', '.join(CKAN_AUTH.values())))
@@ -46,35 +82,379 @@ def authenticated_ckan_session(ckan):
     return s
 
 
-def ckan_packages_of_type(ckan, typ, limit=10000):
-    # 10,000 is hard-coded in the BPA version of CKAN (upped from default limit of 1,000
-    # cache for local dev
-    cache_filename = 'cache/{}.json'.format(typ)
+# 10,000 is hard-coded in the BPA version of CKAN (upped from default limit of 1,000),
+# so we page through package_search rather than asking for everything at once
+CKAN_PAGE_SIZE = 1000
+CKAN_FETCH_WORKERS = 4
+# times a listing which comes up short of its count is fetched again, and the retries
+# with backoff of a page whose response fails as it is read, if the session doesn't say
+CKAN_FETCH_RETRIES = 3
+CKAN_RETRY_BACKOFF = 1.0
+
+
+class Projection(object):
+    """
+    the package fields, and fields of each embedded resource, which an exporter uses.
+    packages are trimmed down to these as they arrive from CKAN, so nothing else is
+    parsed into long-lived objects, cached, or held in memory.
+    """
+    # the fetch and cache layers rely upon these
+    required = ('id', 'type', 'metadata_modified')
+
+    def __init__(self, fields, resource_fields=()):
+        fields = set(fields).union(self.required)
+        if resource_fields:
+            fields.add('resources')
+        self.fields = tuple(sorted(fields))
+        self.resource_fields = tuple(sorted(resource_fields))
+        self.record_type = package_record_type('Package', self.fields, self.resource_fields)
+
+    def __eq__(self, other):
+        return isinstance(other, Projection) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def key(self):
+        return {'fields': list(self.fields), 'resource_fields': list(self.resource_fields)}
+
+    @classmethod
+    def from_key(cls, key):
+        if key is None:
+            return None
+        return cls(key['fields'], key['resource_fields'])
+
+    def record(self, package, keep_raw=False):
+        """
+        a compact record of `package`, holding only the projected fields
+        """
+        return self.record_type.from_dict(package, keep_raw=keep_raw)
+
+    def __call__(self, package):
+        trimmed = dict((k, package[k]) for k in self.fields if k in package)
+        if 'resources' in trimmed:
+            trimmed['resources'] = [
+                dict((k, r[k]) for k in self.resource_fields if k in r) for r in trimmed['resources']]
+        return trimmed
+
+
+def _package_search(ckan, projection, **params):
+    """
+    call package_search, trimming each package to `projection` if given. against a remote
+    CKAN the response is decoded by jsonio, a package at a time, rather than by ckanapi.
+    """
+    import ckanapi
+
+    if not isinstance(ckan, ckanapi.RemoteCKAN):
+        result = ckan.action.package_search(**params)
+        if projection is not None:
+            result['results'] = [projection(t) for t in result['results']]
+        return result
+    headers = {'Content-Type': 'application/json', 'User-Agent': ckan.user_agent}
+    if ckan.apikey:
+        headers['X-CKAN-API-Key'] = headers['Authorization'] = ckan.apikey
+    url = '{}/{}package_search'.format(ckan.address.rstrip('/'), ckan.base_url)
+    # the body is decoded as it arrives, unless responses are being recorded or replayed,
+    # which needs them whole
+    stream = getattr(ckan.session, 'recorder', None) is None
+    response = ckan.session.post(url, data=jsonio.dumps(params), headers=headers, stream=stream)
+    try:
+        if response.status_code != 200:
+            raise ckanapi.CKANAPIError('package_search failed ({}): {}'.format(
+                response.status_code, response.text[:200]))
+        if not stream:
+            count, results = jsonio.search_results(io.BytesIO(response.content), projection)
+        else:
+            response.raw.decode_content = True
+            count, results = jsonio.search_results(response.raw, projection)
+            stats = getattr(ckan.session, 'stats', None)
+            if stats is not None:
+                # the bytes which came over the wire, compressed or not
+                stats.add_bytes(response.raw.tell())
+    finally:
+        response.close()
+    return {'count': count, 'results': results}
+
+
+def _read_errors():
+    """
+    the errors of a response which fails as its body is read. the session retries failed
+    requests (see transport.py), but the body is only read, and decoded, once it has
+    returned, so these are never retried there.
+    """
+    import requests
+    from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+    return (
+        requests.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.Timeout,
+        ProtocolError, ReadTimeoutError, jsonio.DecodeError)
+
+
+def _package_search_page(ckan, typ, start, rows, projection=None, **search):
+    """
+    fetch a single page of package_search results. a page whose response fails as it is
+    read is fetched again, with exponential backoff, up to the session's retries; other
+    errors, such as a 409 for a bad query, are raised at once.
+    """
+    session = getattr(ckan, 'session', None)
+    retries = getattr(session, 'retries', CKAN_FETCH_RETRIES)
+    backoff = getattr(session, 'backoff', CKAN_RETRY_BACKOFF)
+    read_errors = _read_errors()
+    for attempt in range(retries + 1):
+        try:
+            return _package_search(
+                ckan, projection, q='type:%s' % typ, include_private=True, sort='id asc', start=start, rows=rows,
+                **search)
+        except read_errors as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            logger.warn('Retrying package_search (type: {} start: {} rows: {}) in {}s: {!r}'.format(
+                typ, start, rows, delay, e))
+            time.sleep(delay)
+
+
+class IncompleteFetch(Exception):
+    pass
+
+
+def _package_search_pages(ckan, typ, page_size, workers, projection, **search):
+    """
+    yield (count, results) for each page of package_search results, fetching pages in
+    parallel on a pool of `workers` threads; at most `workers` pages are held in memory.
+    CKAN may return fewer rows than asked for (it caps them at its rows_max), so pages
+    are stepped by the number of rows the first page holds.
+    """
+    first = _package_search_page(ckan, typ, 0, page_size, projection, **search)
+    count, step = first['count'], len(first['results'])
+    yield count, first['results']
+    del first
+    if step == 0:
+        if count:
+            raise IncompleteFetch('package_search returned no rows (type: {}) count: {}'.format(typ, count))
+        return
+
+    starts = iter(range(step, count, step))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=typ) as executor:
+        pending = set()
+        for start in itertools.islice(starts, workers):
+            pending.add(executor.submit(_package_search_page, ckan, typ, start, page_size, projection, **search))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for start in itertools.islice(starts, 1):
+                    pending.add(executor.submit(_package_search_page, ckan, typ, start, page_size, projection, **search))
+                yield count, future.result()['results']
+
+
+def ckan_package_pages(ckan, typ, page_size=CKAN_PAGE_SIZE, workers=CKAN_FETCH_WORKERS, retries=CKAN_FETCH_RETRIES, projection=None, **search):
+    """
+    yield each package of type `typ`, fetching pages of `page_size` packages in
+    parallel on a pool of `workers` threads. packages are yielded as their page
+    arrives, so order is not guaranteed; at most `workers` pages are held in memory.
+    if a `projection` is given, each package is trimmed down to it.
+
+    paging is by offset, so packages deleted mid-fetch can shift others past us: if
+    fewer packages are fetched than CKAN counted, the listing is fetched again (up to
+    `retries` times), and only the packages not yet seen are yielded. IncompleteFetch
+    is raised if the count still can't be met.
+    """
+    seen = set()
+
+    def unseen(results):
+        # a package modified mid-fetch may appear twice
+        for package in results:
+            if package['id'] not in seen:
+                seen.add(package['id'])
+                yield package
+
+    for attempt in range(retries + 1):
+        for count, results in _package_search_pages(ckan, typ, page_size, workers, projection, **search):
+            for package in unseen(results):
+                yield package
+        if len(seen) >= count:
+            return
+        logger.warn('Package count changed during fetch (type: {}) expected: {} fetched: {}, fetching again'.format(
+            typ, count, len(seen)))
+    raise IncompleteFetch('Fetched {} of {} packages (type: {})'.format(len(seen), count, typ))
+
+
+def _read_json(filename):
     try:
-        with open(cache_filename) as fd:
+        with open(filename) as fd:
             return json.load(fd)
     except IOError:
-        data = ckan.action.package_search(
-            q='type:%s' % typ, include_private=True, rows=limit)['results']
-        with open(cache_filename, 'w') as fd:
-            json.dump(data, fd, indent=2, sort_keys=True)
-        return data
+        return None
+
+
+def _write_json_atomic(filename, obj):
+    # an interrupted run never leaves a truncated cache behind
+    jsonio.replace_atomic(filename, lambda fd: json.dump(obj, fd, indent=2, sort_keys=True), mode='w')
+
+
+def _read_packages(filename, legacy_filename):
+    """
+    packages cached in the line-delimited `filename`, or in `legacy_filename`, a single
+    JSON document as caches used to be written; None if neither exist
+    """
+    if os.path.exists(filename):
+        return list(jsonio.read_lines(filename))
+    return _read_json(legacy_filename)
 
 
-def common_values(dicts):
+def _solr_date(ckan_date):
+    # CKAN stores metadata_modified as a naive UTC ISO date, which solr wants suffixed with Z
+    return ckan_date if ckan_date.endswith('Z') else ckan_date + 'Z'
+
+
+def high_water_mark(packages):
     """
-    given a list of dicts, return a dict with only the values shared
-    in common between those dicts
+    the latest metadata_modified of `packages`; None if there is none
     """
-    all_keys = set()
-    for d in dicts:
-        all_keys = all_keys.union(set(d.keys()))
-    r = {}
-    for k in all_keys:
-        vals = set([d.get(k) for d in dicts])
-        if len(vals) == 1:
-            r[k] = dicts[0][k]
-    return r
+    return max((t['metadata_modified'] for t in packages if t.get('metadata_modified')), default=None)
+
+
+def ckan_package_changes(ckan, typ, high_water, known_ids, page_size=CKAN_PAGE_SIZE, workers=CKAN_FETCH_WORKERS, projection=None):
+    """
+    returns (live_ids, changed): the ids of every package of type `typ` CKAN currently
+    lists, and the packages modified since `high_water` or not among `known_ids`
+    """
+    # a cheap listing of every live id tells us what has been deleted (or made invisible to us)
+    live_ids = set(t['id'] for t in ckan_package_pages(ckan, typ, page_size=page_size, workers=workers, fl='id'))
+    changed = dict((t['id'], t) for t in ckan_package_pages(
+        ckan, typ, page_size=page_size, workers=workers, projection=projection,
+        fq='metadata_modified:[{} TO *]'.format(_solr_date(high_water))))
+
+    # packages we've never seen which carry an old metadata_modified, for example those
+    # which have just been made visible to us, won't turn up in the changed set
+    missing = sorted(live_ids.difference(known_ids).difference(changed))
+    for i in range(0, len(missing), 100):
+        fq = 'id:({})'.format(' OR '.join(missing[i:i + 100]))
+        changed.update((t['id'], t) for t in ckan_package_pages(
+            ckan, typ, page_size=page_size, workers=workers, projection=projection, fq=fq))
+
+    logger.info('Changes (type: {}) live: {} changed: {} missing: {}'.format(
+        typ, len(live_ids), len(changed), len(missing)))
+    return live_ids, list(changed.values())
+
+
+def sync_packages(ckan, typ, cached, high_water=None, page_size=CKAN_PAGE_SIZE, workers=CKAN_FETCH_WORKERS,
+                  projection=None):
+    """
+    bring `cached`, packages of type `typ`, up to date: fetch only the packages modified
+    since `high_water` (by default, the high-water mark of `cached`), and drop any package
+    no longer listed by CKAN. with no high-water mark, every package is fetched.
+
+    returns (packages, changed, deleted): the packages sorted by id, those of them which
+    differ from `cached`, and the ids of those dropped.
+    """
+    by_id = dict((t['id'], t) for t in cached)
+    if high_water is None:
+        high_water = high_water_mark(cached)
+    if high_water is None:
+        changed = list(ckan_package_pages(ckan, typ, page_size=page_size, workers=workers, projection=projection))
+        live_ids = set(t['id'] for t in changed)
+    else:
+        live_ids, changed = ckan_package_changes(
+            ckan, typ, high_water, set(by_id), page_size=page_size, workers=workers, projection=projection)
+    # packages modified at the high-water mark are always returned again; only count
+    # those which differ from the packages we hold
+    changed = [t for t in changed if by_id.get(t['id']) != t]
+    deleted = set(by_id).difference(live_ids)
+    for package_id in deleted:
+        del by_id[package_id]
+    by_id.update((t['id'], t) for t in changed)
+    logger.info('Synced packages (type: {}) changed: {} deleted: {}'.format(typ, len(changed), len(deleted)))
+    return [by_id[t] for t in sorted(by_id)], changed, deleted
+
+
+def ckan_packages_of_type(ckan, typ, page_size=CKAN_PAGE_SIZE, workers=CKAN_FETCH_WORKERS, projection=None):
+    """
+    return all packages of type `typ`, trimmed to `projection` if given. packages are
+    cached in cache/, a line of JSON per package, along with a high-water mark of their
+    metadata_modified; on subsequent runs only the packages changed since the high-water
+    mark are fetched and merged in by id.
+    """
+    cache_filename = 'cache/{}.jsonl'.format(typ)
+    legacy_filename = 'cache/{}.json'.format(typ)
+    state_filename = 'cache/{}.state.json'.format(typ)
+
+    with stage('cache_read') as measured:
+        data = _read_packages(cache_filename, legacy_filename)
+        state = _read_json(state_filename) or {}
+        measured.count = len(data) if data is not None else 0
+    high_water = state.get('high_water')
+    if data is not None and high_water is None:
+        # caches written before we tracked state: derive the mark from the packages
+        high_water = high_water_mark(data)
+    if Projection.from_key(state.get('projection')) != projection:
+        # the cached packages may be missing fields we now need
+        high_water = None
+
+    with stage('fetch') as measured:
+        if data is None or high_water is None:
+            data = sorted(
+                ckan_package_pages(ckan, typ, page_size=page_size, workers=workers, projection=projection),
+                key=lambda t: t['id'])
+            logger.info('Fetched {} packages (type: {})'.format(len(data), typ))
+        else:
+            data, _, _ = sync_packages(
+                ckan, typ, data, high_water, page_size=page_size, workers=workers, projection=projection)
+        measured.count = len(data)
+
+    with stage('cache_write', count=len(data)):
+        write_package_cache(typ, data, projection)
+    return data
+
+
+def write_package_cache(typ, data, projection=None):
+    """
+    cache `data`, the packages of type `typ` trimmed to `projection`, for
+    ckan_packages_of_type() to sync from
+    """
+    legacy_filename = 'cache/{}.json'.format(typ)
+    jsonio.write_lines('cache/{}.jsonl'.format(typ), data)
+    if os.path.exists(legacy_filename):
+        os.remove(legacy_filename)
+    _write_json_atomic('cache/{}.state.json'.format(typ), {
+        'high_water': high_water_mark(data),
+        'count': len(data),
+        'projection': projection.key() if projection is not None else None,
+        'synced': datetime.datetime.utcnow().isoformat(),
+    })
+
+
+def run_concurrently(call, keys, task):
+    """
+    call `call(key)` for each of `keys` concurrently, each on a thread named for its key
+    (which is logged with each line), and return a dict mapping each key to its result.
+    `task` names what is being run in the log. a failure for one key does not interrupt the
+    others; once all have finished, the first failure is raised.
+    """
+    def named(key):
+        thread = threading.current_thread()
+        name, thread.name = thread.name, key
+        try:
+            return call(key)
+        finally:
+            thread.name = name
+
+    results = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+        futures = dict((executor.submit(named, key), key) for key in keys)
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                logger.error('{} failed ({}): {!r}'.format(task, key, e))
+                errors.append(e)
+            else:
+                logger.info('{} complete ({})'.format(task, key))
+    if errors:
+        raise errors[0]
+    return results
 
 
 def ckan_spatial_to_ncbi_lat_lon(obj, default=''):
@@ -112,24 +492,21 @@ def sample_id_short(sample_id, default=None):
     return sample_id.split('/')[-1]
 
 
-def apply_embargo(ckan_packages, months):
-    def within_embargo(package):
-        ingest_date = package.get('archive_ingestion_date')
-        if not ingest_date:
-            logger.error('Skipping package (no archive_ingestion_date) sample_id: {} id: {} archive_ingestion_date: {} has-resources: {} ticket: {}'.format(
-                package.get('sample_id'), package.get('id'), package.get('archive_ingestion_date'), 'resources' in package, package.get('ticket')))
-            return False
-
-        ingest_date = datetime.datetime.strptime(
-            ingest_date, "%Y-%m-%d").date()
-        if ingest_date + relativedelta(months=3) > datetime.date.today():
-            logger.error('Skipping package (embargoed) sample_id: {0} id: {1} archive_ingestion_date: {2} has-resources: {3}'.format(
-                package.get('sample_id'), package.get('id'), package.get('archive_ingestion_date'), 'resources' in package))
-            return False
-
-        return True
+def embargo_cutoff(months, today=None):
+    """
+    the latest archive_ingestion_date which is out of a `months` long embargo today,
+    as an ISO date string
+    """
+    from dateutil.relativedelta import relativedelta
 
-    return [t for t in ckan_packages if within_embargo(t)]
+    if today is None:
+        today = datetime.date.today()
+    embargo = relativedelta(months=months)
+    cutoff = today - embargo
+    # adding months clamps to the end of the month, so a few later dates may also qualify
+    while cutoff + datetime.timedelta(days=1) + embargo <= today:
+        cutoff += datetime.timedelta(days=1)
+    return cutoff.isoformat()
 
 
 def _build_hiseq_fix_map():
@@ -152,7 +529,7 @@ def fix_instrument_hiseq_model(obj):
     else:
         renamed = _hiseq_fix_map.get(original)
     if renamed is not None and renamed != original:
-        logger.warn('Rename (instrument_model) sample_id: {} id: {} ({} -> {})'.format(
-            obj.get('sample_id'), obj.get('id'), original, renamed))
+        logger.debug('Rename (instrument_model) sample_id: %s id: %s (%s -> %s)',
+                     obj.get('sample_id'), obj.get('id'), original, renamed)
         return renamed
     return original
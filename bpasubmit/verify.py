@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .util import make_logger
+from .filters import Rule
+
+
+logger = make_logger(__name__)
+
+VERIFY_WORKERS = 8
+VERIFY_CHUNK_SIZE = 1 << 20
+
+# outcomes of verifying a resource. only those which are conclusive are checkpointed;
+# resources which could not be downloaded are tried again on the next run. resources
+# with no md5 recorded have nothing to be checked against, and are not downloaded.
+VERIFIED = 'ok'
+MISMATCH = 'mismatch'
+FAILED = 'failed'
+MISSING = 'missing'
+OUTCOMES = (VERIFIED, MISMATCH, FAILED, MISSING)
+
+
+def expected_md5(resource):
+    """
+    the md5 recorded for `resource`, normalised; '' if there is none
+    """
+    return (resource.get('md5') or '').strip().lower()
+
+
+class Throttle(object):
+    """
+    caps the combined rate at which bytes are read by any number of threads
+    """
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(now, self._next) + nbytes / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Checkpoint(object):
+    """
+    a line-delimited JSON log of verified resources, appended to as each completes, so
+    that an interrupted verification resumes where it left off. an entry only stands while
+    the resource's url and expected md5 are unchanged.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename) as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short when a previous run was interrupted
+                        continue
+                    self.entries[entry['id']] = entry
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._fd = open(filename, 'a')
+
+    def get(self, resource):
+        entry = self.entries.get(resource['id'])
+        if entry is not None and entry['url'] == resource['url'] and entry['md5'] == resource['md5']:
+            return entry['status']
+
+    def record(self, resource, status, actual):
+        entry = {'id': resource['id'], 'url': resource['url'], 'md5': resource['md5'], 'status': status, 'actual': actual}
+        with self._lock:
+            self.entries[entry['id']] = entry
+            self._fd.write(json.dumps(entry, sort_keys=True) + '\n')
+            self._fd.flush()
+
+    def close(self):
+        self._fd.close()
+
+
+class MD5Verifier(object):
+    """
+    streams resources from their url through `session`, hashing them in fixed-size chunks,
+    and compares the result with the md5 recorded in CKAN. up to `workers` downloads run at
+    once, and if `bytes_per_second` is given their combined rate is capped to it.
+    """
+
+    def __init__(self, session, checkpoint_filename, workers=VERIFY_WORKERS, bytes_per_second=None,
+                 chunk_size=VERIFY_CHUNK_SIZE):
+        self.session = session
+        self.checkpoint_filename = checkpoint_filename
+        self.workers = workers
+        self.throttle = Throttle(bytes_per_second) if bytes_per_second else None
+        self.chunk_size = chunk_size
+
+    def _md5(self, url):
+        md5 = hashlib.md5()
+        with self.session.get(url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(self.chunk_size):
+                if self.throttle is not None:
+                    self.throttle.consume(len(chunk))
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def _verify(self, checkpoint, resource):
+        try:
+            actual = self._md5(resource['url'])
+            status = VERIFIED if actual == expected_md5(resource) else MISMATCH
+        except Exception as e:
+            logger.debug('Verify failed (download) id: %s url: %s: %r', resource.get('id'), resource.get('url'), e)
+            return FAILED
+        if status == MISMATCH:
+            logger.debug('Verify failed (md5) id: %s url: %s expected: %s actual: %s',
+                         resource['id'], resource['url'], resource['md5'], actual)
+        checkpoint.record(resource, status, actual)
+        return status
+
+    def verify(self, resources):
+        """
+        returns a dict mapping the id of each of `resources` to its outcome
+        """
+        checkpoint = Checkpoint(self.checkpoint_filename)
+        results = {}
+        pending = []
+        for resource in resources:
+            if resource['id'] in results:
+                continue
+            if not expected_md5(resource):
+                results[resource['id']] = MISSING
+                continue
+            status = checkpoint.get(resource)
+            if status is not None:
+                results[resource['id']] = status
+            else:
+                results[resource['id']] = None
+                pending.append(resource)
+        resumed = sum(1 for t in results.values() if t is not None and t != MISSING)
+        logger.info('Verifying md5 of {} resources ({} resumed from checkpoint)'.format(len(pending), resumed))
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = dict((executor.submit(self._verify, checkpoint, t), t['id']) for t in pending)
+                for done, future in enumerate(as_completed(futures), start=1):
+                    results[futures[future]] = future.result()
+                    if done % 1000 == 0:
+                        logger.info('Verified {} of {} resources'.format(done, len(pending)))
+        finally:
+            checkpoint.close()
+        counts = dict((status, sum(1 for t in results.values() if t == status)) for status in OUTCOMES)
+        logger.info('Verified md5 in {:.1f}s: ok {} mismatch {} failed {} missing {}'.format(
+            time.monotonic() - start, counts[VERIFIED], counts[MISMATCH], counts[FAILED], counts[MISSING]))
+        return results
+
+
+def verification_rules(results):
+    """
+    filter rules over SRA rows, each with the `resources` to be submitted in it, which drop
+    a row if any of its resources failed verification: the files of a row are submitted
+    together, or not at all.
+    """
+    def none_are(outcome):
+        return lambda row: all(results.get(resource['id']) != outcome for resource in row['resources'])
+
+    return (
+        Rule('md5 missing', none_are(MISSING)),
+        Rule('md5 unverified', none_are(FAILED)),
+        Rule('md5 mismatch', none_are(MISMATCH)),
+    )
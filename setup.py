@@ -13,5 +13,10 @@ setup(author="CCG, Murdoch University",
       entry_points={
           'console_scripts': [
               'bpa-submit=bpasubmit.cli:main',
+              'bpa-fake-ckan=bpasubmit.fakeckan:main',
+          ],
+          'bpasubmit.exporters': [
+              'base-ncbi=bpasubmit.projects.base.submission:BASE',
+              'mm-ncbi=bpasubmit.projects.mm.submission:MarineMicrobes',
           ],
       })
@@ -0,0 +1,33 @@
+import pytest
+
+from bpasubmit.fakeckan import FakeCKANServer
+from bpasubmit.synthetic import synthetic_packages, PROJECT_TYPES
+
+from helpers import NPACKAGES
+
+
+@pytest.fixture
+def serve():
+    """
+    start fake CKAN servers over the synthetic packages of every project, passing any
+    options on to FakeCKANServer; they are stopped after the test
+    """
+    servers = []
+
+    def serve(**kwargs):
+        packages = [t for project in sorted(PROJECT_TYPES) for t in synthetic_packages(NPACKAGES, project)]
+        server = FakeCKANServer(packages, fix_md5=True, resource_bytes=64, **kwargs)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield serve
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # packages are cached in cache/ within the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,52 @@
+"""
+helpers for the tests which run the exporters end to end against the fake CKAN server
+"""
+import argparse
+import filecmp
+
+from bpasubmit.cli import run_exporters
+from bpasubmit.diagnostics import Diagnostics
+from bpasubmit.projects import load_exporter
+from bpasubmit.util import make_ckan_api
+
+
+EXPORTERS = ('base-ncbi', 'mm-ncbi')
+NPACKAGES = 600
+
+
+def make_args(server, output_dir, **kwargs):
+    args = dict(
+        api_key='key', ckan_url=server.address, fetch_workers=2, retries=2, timeout=30, record=None, replay=None,
+        store=None, packing='ffd', output_dir=str(output_dir), write_workers=1, compress=None, archive=False,
+        write_buffer=1.0, verify_md5=False, verify_workers=2, verify_bandwidth=0, incremental=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def export(args):
+    exporters = dict((name, load_exporter(name)) for name in EXPORTERS)
+    ckan = make_ckan_api(args, concurrent_types=sum(len(t.package_types) for t in exporters.values()),
+                         downloads=args.verify_workers * len(exporters) if args.verify_md5 else 0)
+    diagnostics = Diagnostics()
+    run_exporters(ckan, args, exporters, diagnostics)
+    return diagnostics
+
+
+def fresh_cache(workdir):
+    cache = workdir / 'cache'
+    for filename in cache.glob('*') if cache.exists() else ():
+        filename.unlink()
+    cache.mkdir(exist_ok=True)
+
+
+def assert_same_tree(a, b):
+    comparison = filecmp.dircmp(str(a), str(b))
+    assert not comparison.left_only and not comparison.right_only and not comparison.funny_files
+    _, mismatch, errors = filecmp.cmpfiles(str(a), str(b), comparison.common_files, shallow=False)
+    assert not mismatch and not errors
+    for name in comparison.common_dirs:
+        assert_same_tree(a / name, b / name)
+
+
+def sra_files(output_dir):
+    return sorted(output_dir.glob('*/SRA_subtemplate_*.tsv'))
@@ -0,0 +1,62 @@
+"""
+regression tests which run the exporters end to end against the fake CKAN server
+"""
+import hashlib
+import json
+import os
+
+from bpasubmit.ncbi import NCBISRASubtemplate, NCBIBioSampleMetagenomeEnvironmental
+from bpasubmit.projects import load_exporter
+
+from helpers import EXPORTERS, assert_same_tree, export, fresh_cache, make_args
+
+
+def test_files_match_their_manifest_and_chunk_limits(serve, workdir):
+    server = serve()
+    fresh_cache(workdir)
+    export(make_args(server, workdir / 'output'))
+
+    for name, project in (('base-ncbi', 'BASE'), ('mm-ncbi', 'MM')):
+        output_dir = workdir / 'output' / name
+        with open(str(output_dir / 'manifest-{}.json'.format(project))) as fd:
+            manifest = json.load(fd)
+        assert manifest
+        for entry in manifest:
+            with open(str(output_dir / entry['filename']), 'rb') as fd:
+                data = fd.read()
+            assert hashlib.md5(data).hexdigest() == entry['md5']
+            assert len(data) == entry['bytes']
+            limit = NCBISRASubtemplate.chunk_size
+            if entry['filename'].startswith('Metagenome'):
+                limit = NCBIBioSampleMetagenomeEnvironmental.chunk_size
+            assert entry['rows'] <= limit
+
+
+def test_packing_is_stable_across_write_workers(serve, workdir):
+    server = serve()
+    fresh_cache(workdir)
+    export(make_args(server, workdir / 'one', packing='ordered'))
+    export(make_args(server, workdir / 'two', packing='ordered', write_workers=2))
+    assert_same_tree(workdir / 'one', workdir / 'two')
+
+
+def test_store_writes_what_the_cache_does(serve, workdir):
+    server = serve()
+    fresh_cache(workdir)
+    cached = export(make_args(server, workdir / 'cache-output'))
+    stored = export(make_args(server, workdir / 'store-output', store=str(workdir / 'packages.db')))
+    assert_same_tree(workdir / 'cache-output', workdir / 'store-output')
+    # and skips the same packages, for the same reasons
+    assert sorted(cached.stages, key=lambda t: (t['project'], t['stage'])) == sorted(
+        stored.stages, key=lambda t: (t['project'], t['stage']))
+
+
+def test_incremental_writes_only_changes(serve, workdir):
+    server = serve()
+    fresh_cache(workdir)
+    args = make_args(server, workdir / 'output', incremental=True)
+    export(args)
+    export(args)
+    for name in EXPORTERS:
+        assert sorted(os.listdir(str(workdir / 'output' / name))) == [
+            'batch-0001', 'submitted-{}.json'.format(load_exporter(name).name)]
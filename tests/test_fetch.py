@@ -0,0 +1,106 @@
+"""
+tests of fetching packages from CKAN
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ckanapi
+import pytest
+
+from bpasubmit.synthetic import PROJECT_TYPES
+from bpasubmit.util import _package_search_page, make_ckan_api
+
+from helpers import assert_same_tree, export, fresh_cache, make_args
+
+
+PACKAGES = [{'id': 'package-{}'.format(i), 'type': 'test'} for i in range(3)]
+
+
+def test_fetches_every_package_when_ckan_caps_rows(serve, workdir):
+    full = serve()
+    fresh_cache(workdir)
+    export(make_args(full, workdir / 'full'))
+
+    # CKAN caps rows at its rows_max, which may be below the page size asked for
+    capped = serve(page_limit=70)
+    fresh_cache(workdir)
+    export(make_args(capped, workdir / 'capped'))
+
+    for typ in (typ for types in PROJECT_TYPES.values() for typ in types):
+        expected = sum(1 for t in capped.packages if t['type'] == typ)
+        with open('cache/{}.jsonl'.format(typ)) as fd:
+            assert sum(1 for _ in fd) == expected
+    assert_same_tree(workdir / 'full', workdir / 'capped')
+
+
+@pytest.fixture
+def flaky():
+    """
+    a CKAN which answers package_search with the `responses` given, in turn: 'cut' to cut
+    the body off mid-read, or a status code
+    """
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            requests.append(self.path)
+            response = server.responses.pop(0) if server.responses else 200
+            status = 200 if response == 'cut' else response
+            body = json.dumps({'success': status == 200, 'result': {'count': len(PACKAGES), 'results': PACKAGES}})
+            body = body.encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if response == 'cut':
+                self.wfile.write(body[:len(body) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.requests = requests
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_flaky_ckan(server, retries):
+    args = argparse.Namespace(
+        api_key=None, ckan_url='http://127.0.0.1:{}'.format(server.server_address[1]), fetch_workers=1,
+        retries=retries, timeout=30, record=None, replay=None)
+    ckan = make_ckan_api(args)
+    ckan.session.backoff = 0
+    return ckan
+
+
+def test_page_cut_off_mid_read_is_fetched_again(flaky):
+    flaky.responses = ['cut', 'cut']
+    result = _package_search_page(make_flaky_ckan(flaky, retries=2), 'test', 0, 10)
+    assert result == {'count': len(PACKAGES), 'results': PACKAGES}
+    assert len(flaky.requests) == 3
+
+
+def test_page_cut_off_every_time_fails_after_retries(flaky):
+    flaky.responses = ['cut'] * 3
+    with pytest.raises(Exception):
+        _package_search_page(make_flaky_ckan(flaky, retries=2), 'test', 0, 10)
+    assert len(flaky.requests) == 3
+
+
+def test_page_refused_by_ckan_fails_at_once(flaky):
+    flaky.responses = [409]
+    with pytest.raises(ckanapi.CKANAPIError):
+        _package_search_page(make_flaky_ckan(flaky, retries=2), 'test', 0, 10)
+    assert len(flaky.requests) == 1
@@ -0,0 +1,19 @@
+"""
+tests of grouping packages by sample, and taking the values common to each group
+"""
+import pytest
+
+from bpasubmit.grouping import group_common
+
+
+@pytest.mark.parametrize('values, common', [
+    (('1', '1'), '1'),
+    ((1, '1'), '1'),
+    ((None, None), 'None'),
+    ((150, 150.0), None),
+    ((True, 1), None),
+    (('a', 'b'), None),
+])
+def test_group_common_compares_values_as_strings(values, common):
+    records = group_common([{'field': t} for t in values], lambda package: 0, ('field',))
+    assert records == [{'field': common} if common is not None else {}]
@@ -0,0 +1,33 @@
+"""
+tests of verifying the md5 of each resource before it is submitted
+"""
+from helpers import export, fresh_cache, make_args, sra_files
+
+
+def test_verify_md5_skips_rows_with_no_md5(serve, workdir, monkeypatch):
+    monkeypatch.setenv('CKAN_USERNAME', 'user')
+    monkeypatch.setenv('CKAN_PASSWORD', 'password')
+    server = serve()
+    fresh_cache(workdir)
+    export(make_args(server, workdir / 'before'))
+
+    # a package with more than one file submitted, one of which has no md5
+    submitted = ''.join(open(str(t)).read() for t in sra_files(workdir / 'before'))
+    resources = next(
+        resources for resources in (
+            [server.resources[r['id']] for r in package['resources'] if server.resources[r['id']]['md5'] in submitted]
+            for package in server.packages)
+        if len(resources) > 1)
+    resources[0]['md5'] = None
+
+    fresh_cache(workdir)
+    diagnostics = export(make_args(server, workdir / 'after', verify_md5=True))
+
+    # its row is skipped whole, rather than submitted without one of its files
+    submitted = ''.join(open(str(t)).read() for t in sra_files(workdir / 'after'))
+    assert not any(t['md5'] in submitted for t in resources[1:])
+    skipped = dict(
+        (t['reason'], t['count']) for stage in diagnostics.stages if stage['stage'] == 'verify'
+        for t in stage['skipped'])
+    assert skipped.get('md5 missing') == 1
+    assert 'md5 mismatch' not in skipped